@@ -1,18 +1,41 @@
 import json
 import html
+import builtins
+import bisect
+import inspect
 import re
 import copy
 import os.path
 import sys
+import io
+import time
+import threading
+import timeit
+import functools
+import traceback
+import weakref
+import gc
+import itertools
 import unicodedata
 from datetime import datetime
 from collections import namedtuple, OrderedDict
+from concurrent.futures import Future
 
+import aqt
 from aqt import gui_hooks, mw
 from aqt.qt import *
 from aqt.studydeck import StudyDeck
-
-from aqt.utils import showInfo, tooltip, KeyboardModifiersPressed
+from aqt.browser import Browser
+from aqt.addcards import AddCards
+from aqt.editor import Editor
+
+from aqt.operations import CollectionOp, QueryOp
+from aqt.operations.note import update_notes
+from anki.notes import NoteFieldsCheckResult
+from anki import hooks
+from anki.utils import html_to_text_line, strip_html, strip_html_media
+from aqt.utils import (showInfo, showWarning, askUser, tooltip, closeTooltip,
+                       KeyboardModifiersPressed)
     
 
 # Extension base class
@@ -23,11 +46,7 @@ class Extension:
 
     def setup_shortcuts(self):
         self.disable_used_keys()
-        for command_name, (key_seq, shortcut) in self.bindings.items():
-            if shortcut is None:
-                method = getattr(self, command_name)
-                shortcut = QShortcut(key_seq, self.widget, activated=method)
-                self.bindings[command_name][1] = shortcut
+        ChordDispatcher.for_window(self.editor.parentWindow).add_extension(self)
 
     def disable_used_keys(self):
         attr = f"{self}_did_disable_used_keys"
@@ -36,7 +55,9 @@ class Extension:
             return
         shortcuts = self.editor.parentWindow.findChildren(QShortcut)
         actions = self.editor.parentWindow.findChildren(QAction)
-        for (key_seq, shortcut) in self.bindings.values():
+        for (key_seq, enabled) in self.bindings.values():
+            if key_seq is None:
+                continue
             for shortcut in shortcuts:
                 if self.qkeyseqs_equal(shortcut.key(), key_seq):
                     # remove the shortcut
@@ -65,19 +86,44 @@ class Extension:
         COMMAND_NAME must be the name of a method which plays the role of a
         command. If it is not, nothing happens. It disables the command in the
         sense that pressing its key sequence will not invoke it."""
-        shortcut = self.bindings[command_name][1]
-        if shortcut is not None:
-            shortcut.setEnabled(False)
+        if command_name in self.bindings:
+            self.bindings[command_name][1] = False
 
     def enable_command(self, command_name):
         """Make sure to call this only after (self.setup_shortcuts).
         COMMAND_NAME must be the name of a method which plays the role of a
         command. If it is not, nothing happens. It enables the command in the
         sense that pressing its key sequence will invoke it."""
-        shortcut = self.bindings[command_name][1]
-        if shortcut is not None:
-            shortcut.setEnabled(True)
+        if command_name in self.bindings:
+            self.bindings[command_name][1] = True
+
+    def key_sequence_undefined(self):
+        """Called by ChordDispatcher when an undefined key sequence was
+        pressed in the window of SELF"""
+
+    def command_dispatched(self, command_name):
+        """Called by ChordDispatcher after it invoked COMMAND_NAME (of any
+        extension) in the window of SELF"""
     
+    # lifecycle. Hooks are registered through SELF.ADD_HOOK and removed when
+    # the widget of the extension goes away, so that closed windows don't
+    # leave their handlers (and themselves) behind.
+    # ════════════════════════════════════════
+
+    def setup_lifecycle(self):
+        self.hooks = []
+        qconnect(self.widget.destroyed, self.teardown)
+
+    def add_hook(self, hook, callback):
+        hook.append(callback)
+        self.hooks.append((hook, callback))
+
+    def teardown(self, *args):
+        """Removes the hooks of SELF. Safe to call more than once."""
+        for hook, callback in self.hooks:
+            hook.remove(callback)
+        self.hooks = []
+
     # misc
     # ════════════════════════════════════════
     
@@ -85,23 +131,865 @@ class Extension:
         self.web.setFocus()
         self.eval_js(f"focusField({N})")
 
+    # JavaScript evaluation. Between SELF.BEGIN_JS_BATCH and SELF.END_JS_BATCH,
+    # the code passed to SELF.EVAL_JS is collected and sent to the webview as
+    # a single evaluation. Page actions and evaluations with callbacks flush the
+    # collected code first, so that the order of the effects is preserved.
+    js_batch = None
+
     def eval_js(self, js):
-        self.web.eval(js)
-        
+        if self.js_batch is not None:
+            self.js_batch.append(js)
+        else:
+            self.web.eval(js)
+
+    def eval_js_with_callback(self, js, callback):
+        self.flush_js_batch()
+        self.pending_begin()
+        def pending_callback(result):
+            try:
+                callback(result)
+            finally:
+                self.pending_end()
+        self.web.evalWithCallback(js, pending_callback)
+
+    def trigger_page_action(self, action):
+        self.flush_js_batch()
+        self.web.triggerPageAction(action)
+
+    def begin_js_batch(self):
+        self.js_batch = []
+
+    def flush_js_batch(self):
+        if self.js_batch:
+            self.web.eval("\n;\n".join(self.js_batch))
+            self.js_batch = []
+
+    def end_js_batch(self):
+        self.flush_js_batch()
+        self.js_batch = None
+
+    # The evaluations with callbacks (and, in the editor, the bridge requests)
+    # whose answers haven't arrived yet are counted, so that SELF.AFTER_PENDING
+    # can wait for them.
+    pending_count = 0
+    pending_waiters = None
+
+    def pending_begin(self):
+        self.pending_count += 1
+
+    def pending_end(self):
+        self.pending_count -= 1
+        if self.pending_count == 0 and self.pending_waiters:
+            waiters, self.pending_waiters = self.pending_waiters, None
+            for waiter in waiters:
+                waiter()
+
+    def after_pending(self, callback):
+        """Calls CALLBACK once the pending callbacks have run. The collected
+        JavaScript is flushed first, as it may contain pending requests."""
+        self.flush_js_batch()
+        if self.pending_count == 0:
+            callback()
+        else:
+            if self.pending_waiters is None:
+                self.pending_waiters = []
+            self.pending_waiters.append(callback)
+
+# Key chords
+# ════════════════════════════════════════
+
+class ChordDispatcher(QObject):
+    """Invokes the commands of the extensions in a window when their key
+    sequences are pressed. The sequences are kept in a prefix trie whose inner
+    nodes are dicts mapping a key combination to the next node, and whose
+    leaves are pairs (EXTENSION, COMMAND_NAME). Each key press moves one node
+    down, and the command is invoked as soon as a leaf is reached, so there is
+    no ambiguity for Qt to resolve as there is with multi-key QShortcuts. While
+    a sequence is incomplete, the keys pressed so far are shown in a
+    tooltip."""
+
+    # Keys typed into these widgets are left alone, as they need them for
+    # editing.
+    TEXT_INPUTS = (QLineEdit, QTextEdit, QPlainTextEdit, QAbstractSpinBox)
+    MODIFIER_KEYS = {Qt.Key_Control, Qt.Key_Shift, Qt.Key_Alt, Qt.Key_Meta,
+                     Qt.Key_AltGr, Qt.Key_CapsLock}
+    # The conflicting key sequences already reported, so that each one is
+    # reported once rather than for every window
+    reported_conflicts = set()
+
+    @classmethod
+    def for_window(cls, window):
+        """Returns the dispatcher of WINDOW, creating it if needed"""
+        # Use a deliberately long identifier to avoid possible conflicts
+        attr = "_editor_extensions_chord_dispatcher"
+        dispatcher = getattr(window, attr, None)
+        if dispatcher is None:
+            dispatcher = cls(window)
+            setattr(window, attr, dispatcher)
+        return dispatcher
+
+    def __init__(self, window):
+        # As a child of WINDOW, the dispatcher is destroyed along with it,
+        # which also uninstalls the event filter.
+        super().__init__(window)
+        self.window = window
+        self.trie = {}
+        self.node = self.trie
+        self.pending = []
+        self.extensions = weakref.WeakSet()
+        mw.app.installEventFilter(self)
+
+    def add_extension(self, ext):
+        self.extensions.add(ext)
+        conflicts = []
+        for command_name, (key_seq, enabled) in ext.bindings.items():
+            if key_seq is None:
+                # Unbound in KEY_BINDINGS_PATH
+                continue
+            keys = [key_seq[i] for i in range(key_seq.count())]
+            node = self.trie
+            for key in keys[:-1]:
+                node = node.setdefault(key, {})
+                if not isinstance(node, dict):
+                    break
+            else:
+                if isinstance(node.get(keys[-1]), dict):
+                    node = None
+                else:
+                    node[keys[-1]] = (ext, command_name)
+            if not isinstance(node, dict):
+                conflict = f"{command_name} ({key_seq.toString()})"
+                if conflict not in self.reported_conflicts:
+                    self.reported_conflicts.add(conflict)
+                    conflicts.append(conflict)
+        if conflicts:
+            showWarning("The key sequences of these commands conflict with "
+                        "others, and are ignored:\n\n" + "\n".join(conflicts),
+                        parent=self.window)
+
+    def reset(self):
+        self.node = self.trie
+        self.pending = []
+
+    def lookup(self, key, modifiers):
+        """Returns the child of the current node for the given key press, or
+        None. Shifted symbols (such as "<" or "(") are bound without the Shift
+        modifier, so for them that is tried too. Letters and other keys are
+        not, so that e.g. Ctrl+Shift+X stays distinct from Ctrl+X."""
+        candidates = [modifiers]
+        if modifiers & Qt.ShiftModifier and self.is_symbol(key):
+            candidates.append(modifiers & ~int(Qt.ShiftModifier))
+        for mods in candidates:
+            child = self.node.get(mods | key)
+            if child is None:
+                continue
+            if isinstance(child, dict):
+                return child
+            ext, command_name = child
+            if ext.bindings[command_name][1]:
+                return child
+        return None
+
+    @staticmethod
+    def is_symbol(key):
+        """Whether KEY is a printable ASCII symbol, other than a letter"""
+        return (Qt.Key_Exclam <= key <= Qt.Key_AsciiTilde and
+                not Qt.Key_A <= key <= Qt.Key_Z)
+
+    def eventFilter(self, obj, event):
+        event_type = event.type()
+        if event_type not in (QEvent.KeyPress, QEvent.ShortcutOverride):
+            return False
+        if (not isinstance(obj, QWidget) or obj.window() is not self.window or
+            isinstance(obj, self.TEXT_INPUTS)):
+            return False
+        key = event.key()
+        if key in self.MODIFIER_KEYS:
+            return False
+        modifiers = int(event.modifiers()) & ~int(Qt.KeypadModifier)
+        child = self.lookup(key, modifiers)
+        if event_type == QEvent.ShortcutOverride:
+            # Claim the key, so that it is delivered as a KeyPress (to this
+            # filter) instead of triggering some other shortcut.
+            if child is None and not self.pending:
+                return False
+            event.accept()
+            return True
+        if child is None:
+            if not self.pending:
+                return False
+            self.pending.append(QKeySequence(modifiers | key).toString())
+            tooltip(", ".join(self.pending) + " is undefined")
+            self.reset()
+            for ext in list(self.extensions):
+                ext.key_sequence_undefined()
+            return True
+        if isinstance(child, dict):
+            self.node = child
+            self.pending.append(QKeySequence(modifiers | key).toString())
+            tooltip(", ".join(self.pending) + " -")
+            return True
+        if self.pending:
+            closeTooltip()
+        self.reset()
+        ext, command_name = child
+        getattr(ext, command_name)()
+        for other in list(self.extensions):
+            other.command_dispatched(command_name)
+        return True
+
+KEY_BINDINGS_PATH = os.path.realpath(
+    os.path.join(os.path.dirname(__file__),
+                 "user_data", "key_bindings.json"))
+
+def load_key_bindings(commands):
+    """Overrides the key sequences in COMMANDS (editor_commands or
+    addcards_commands) with those in KEY_BINDINGS_PATH, if it exists. The file
+    maps command names to key sequences (such as "Ctrl+X, S, S"), or to null to
+    unbind a command. Unbound commands are kept with a None key sequence, so
+    that they can still be run from the command palette."""
+    try:
+        with open(KEY_BINDINGS_PATH) as f:
+            bindings = json.load(f)
+    except FileNotFoundError:
+        return
+    for command_name, key_seq_str in bindings.items():
+        if command_name not in commands:
+            continue
+        commands[command_name][0] = (None if key_seq_str is None
+                                     else QKeySequence(key_seq_str))
+
+# Configuration
+# ════════════════════════════════════════
+
+def config_get(key):
+    """Returns the value of KEY in the addon's configuration (editable through
+    Tools -> Addons -> Config). Keys missing from the user's configuration fall
+    back to the defaults in config.json."""
+    config = mw.addonManager.getConfig(__name__) or {}
+    if key not in config:
+        config = mw.addonManager.addonConfigDefaults(__name__)
+    return config[key]
+
+# Kill ring
+# ════════════════════════════════════════
+
+class KillRing:
+    """An Emacs-like kill ring shared by all editors. Entries are pairs
+    (HTML, TEXT), the most recent one first. The total size of the entries is
+    kept under a budget (the "kill_ring_max_bytes" configuration key) by
+    dropping the oldest ones. The system clipboard is only synchronized when
+    the application loses (export) or gains (import) focus, so that killing and
+    yanking inside Anki never goes through it. The HTML of imported entries
+    comes from other applications, so it is filtered when yanked (see
+    EditorExtension.emacs_yank_html)."""
+
+    def __init__(self):
+        self.entries = []
+        self.size = 0
+        # The index of the entry which was last yanked. Rotated by yank-pop.
+        self.yank_index = 0
+        # The text last exchanged with the system clipboard, used to tell
+        # whether either side has changed since. Only the text is compared, as
+        # the HTML may be rewritten by the platform's clipboard.
+        self.synced = None
+        # The entries imported from the system clipboard
+        self.imported = set()
+
+    @staticmethod
+    def entry_size(entry):
+        return sum(len(part.encode("utf-8")) for part in entry)
+
+    def push(self, html, text):
+        entry = (html, text)
+        if self.entries and self.entries[0] == entry:
+            return
+        self.entries.insert(0, entry)
+        self.size += self.entry_size(entry)
+        budget = config_get("kill_ring_max_bytes")
+        # Always keep the newest entry, even when it alone exceeds the budget.
+        while self.size > budget and len(self.entries) > 1:
+            dropped = self.entries.pop()
+            self.size -= self.entry_size(dropped)
+            if dropped not in self.entries:
+                self.imported.discard(dropped)
+        self.yank_index = 0
+
+    def current(self):
+        """Returns the entry to yank and resets the yank-pop rotation."""
+        if not self.entries:
+            return None
+        self.yank_index = 0
+        return self.entries[0]
+
+    def next_entry(self):
+        """Returns the entry to replace the last yanked one with. The
+        rotation only happens with SELF.ROTATE, once the replacement was
+        done."""
+        if not self.entries:
+            return None
+        return self.entries[(self.yank_index + 1) % len(self.entries)]
+
+    def rotate(self):
+        if self.entries:
+            self.yank_index = (self.yank_index + 1) % len(self.entries)
+
+    def is_imported(self, entry):
+        return entry in self.imported
+
+    def on_application_state_changed(self, state):
+        if state == Qt.ApplicationActive:
+            self.import_clipboard()
+        elif self.entries:
+            self.export_clipboard()
+
+    def import_clipboard(self):
+        """Pushes the system clipboard onto the ring if it was changed outside
+        of Anki since the last synchronization."""
+        mime = mw.app.clipboard().mimeData()
+        if mime is None:
+            return
+        text = mime.text()
+        if text and text != self.synced:
+            self.synced = text
+            html = mime.html() if mime.hasHtml() else html_escape_text(text)
+            self.push(html, text)
+            if mime.hasHtml():
+                self.imported.add((html, text))
+
+    def export_clipboard(self):
+        html, text = self.entries[0]
+        if text == self.synced:
+            return
+        mime = QMimeData()
+        mime.setHtml(html)
+        mime.setText(text)
+        mw.app.clipboard().setMimeData(mime)
+        self.synced = text
+
+def html_escape_text(text):
+    return html.escape(text).replace("\n", "<br>")
+
+kill_ring = KillRing()
+
+# Code history
+# ════════════════════════════════════════
+
+class CodeHistory:
+    """The code evaluated through misc_RunCodeDialog, one list per language,
+    shared by all editors. Each list keeps at most MAX_LENGTH entries and is
+    persisted after every change."""
+
+    PATH = os.path.realpath(
+        os.path.join(os.path.dirname(__file__),
+                     "user_data", "code_history.json"))
+    MAX_LENGTH = 200
+
+    def __init__(self):
+        # Read lazily, on the first use.
+        self.histories = None
+
+    def get(self, lang):
+        """Returns the history of LANG. The list is updated in place, so the
+        caller may keep a reference to it."""
+        if self.histories is None:
+            self.read()
+        return self.histories.setdefault(lang, [])
+
+    def append(self, lang, text):
+        history = self.get(lang)
+        if history and history[-1] == text:
+            return
+        history.append(text)
+        del history[:-self.MAX_LENGTH]
+        self.write()
+
+    def read(self):
+        try:
+            with open(self.PATH) as f:
+                self.histories = json.load(f)
+        except (OSError, ValueError):
+            # Missing, or corrupted (e.g. partially written)
+            self.histories = {}
+
+    def write(self):
+        os.makedirs(os.path.dirname(self.PATH), exist_ok=True)
+        with open(self.PATH, "w") as f:
+            json.dump(self.histories, f)
+
+code_history = CodeHistory()
+
+def format_duration(seconds):
+    for unit, scale in (("s", 1), ("ms", 1e-3), ("µs", 1e-6)):
+        if seconds >= scale:
+            return f"{seconds/scale:.3g} {unit}"
+    return f"{seconds/1e-9:.3g} ns"
+
+# Scratch scripts
+# ════════════════════════════════════════
+
+class ScratchScripts:
+    """The scripts listed in the "scratch_scripts" configuration key. JavaScript
+    files are evaluated in the editor and Python files are executed with `ext`
+    bound to the editor extension. The files are watched, and each one is read
+    (and, for Python, compiled) only when it changes, at which point it is run
+    again in every open editor."""
+
+    def __init__(self):
+        self.watcher = None
+        self.paths = []
+        # Maps a path to a pair (SOURCE, CODE), where CODE is the JavaScript
+        # source or the compiled Python code.
+        self.cache = {}
+
+    def setup(self):
+        self.watcher = QFileSystemWatcher()
+        qconnect(self.watcher.fileChanged, self.on_file_changed)
+        self.update_paths()
+
+    def update_paths(self, config=None):
+        """Called initially and whenever the configuration is changed"""
+        if config is None:
+            scripts = config_get("scratch_scripts")
+        else:
+            scripts = config.get("scratch_scripts", [])
+        paths = [os.path.expanduser(path) for path in scripts]
+        watched = set(self.watcher.files())
+        removed = watched.difference(paths)
+        if removed:
+            self.watcher.removePaths(list(removed))
+        for path in paths:
+            if path not in watched and os.path.exists(path):
+                self.watcher.addPath(path)
+        self.cache = {path: entry for path, entry in self.cache.items()
+                      if path in paths}
+        self.paths = paths
+        for path in paths:
+            self.load(path)
+
+    def load(self, path):
+        """Reads the script at PATH into the cache. Returns True when it was
+        changed since the last time it was read."""
+        try:
+            with open(path) as f:
+                source = f.read()
+        except OSError:
+            self.cache.pop(path, None)
+            return False
+        cached = self.cache.get(path)
+        if cached is not None and cached[0] == source:
+            return False
+        if path.endswith(".py"):
+            try:
+                code = compile(source, path, "exec")
+            except SyntaxError:
+                traceback.print_exc()
+                tooltip(f'Syntax error in "{os.path.basename(path)}"')
+                return False
+        else:
+            code = source
+        self.cache[path] = (source, code)
+        return True
+
+    def on_file_changed(self, path):
+        # Editors which save by replacing the file make the watcher drop it.
+        if path not in self.watcher.files() and os.path.exists(path):
+            self.watcher.addPath(path)
+        if self.load(path):
+            for ext in list(editor_extensions):
+                self.run(ext, path)
+
+    def run(self, ext, path):
+        if path not in self.cache:
+            return
+        code = self.cache[path][1]
+        if path.endswith(".py"):
+            try:
+                # A single namespace (a copy of the addon's globals), so that
+                # the definitions of the script can see each other.
+                exec(code, {**globals(), "__builtins__": builtins, "ext": ext})
+            except Exception:
+                traceback.print_exc()
+                return
+        else:
+            ext.eval_js(code)
+        print(f"### Executed \"{os.path.basename(path)}\"")
+
+    def run_all(self, ext):
+        if not self.cache:
+            tooltip("No scratch scripts (see the scratch_scripts option)")
+        for path in self.paths:
+            self.run(ext, path)
+
+scratch_scripts = ScratchScripts()
+
+# HTML text
+# ════════════════════════════════════════
+
+HTML_TAG_SPLIT_REGEX = re.compile(r"(<[^>]*>)")
+
+def html_tokens(field_html):
+    """Returns the list of the tokens of FIELD_HTML, with the text at even
+    indexes and the tags at odd indexes"""
+    return HTML_TAG_SPLIT_REGEX.split(field_html)
+
+class HtmlText:
+    """A text token of HTML (see html_tokens) with its character entities
+    decoded, so that it can be searched without matching inside an entity.
+    SELF.TEXT is the decoded text, with non-breaking spaces as plain spaces,
+    and SELF.RAW_OFFSET maps an offset into it back to one into SELF.RAW."""
+
+    ENTITY_REGEX = re.compile(
+        r"&(?:#[0-9]+|#[xX][0-9a-fA-F]+|[a-zA-Z][a-zA-Z0-9]*);?")
+
+    def __init__(self, raw):
+        self.raw = raw
+        chars = []
+        # The offset into RAW of each character of the decoded text. The
+        # characters of an entity map to the offset of its "&".
+        self.offsets = []
+        position = 0
+        for match in self.ENTITY_REGEX.finditer(raw):
+            decoded = html.unescape(match.group())
+            if decoded == match.group():
+                # Not an entity, the characters are kept as they are
+                continue
+            chars.append(raw[position:match.start()])
+            self.offsets.extend(range(position, match.start()))
+            chars.append(decoded)
+            self.offsets.extend([match.start()] * len(decoded))
+            position = match.end()
+        chars.append(raw[position:])
+        self.offsets.extend(range(position, len(raw) + 1))
+        self.text = "".join(chars).replace("\xa0", " ")
+
+    def raw_offset(self, offset):
+        return self.offsets[offset]
+
+# Aho-Corasick automaton
+# ════════════════════════════════════════
+
+class AhoCorasick:
+    """Finds all occurrences of a set of patterns in a text in a single pass,
+    in time linear in the size of the text (plus the number of
+    occurrences). Used to find the identifiers mentioned in notes."""
+
+    def __init__(self, patterns):
+        # The states are indexes into the following lists. State 0 is the root.
+        self.goto = [{}]
+        self.fail = [0]
+        # The pattern which ends at each state, or None
+        self.pattern = [None]
+        # The nearest state on the fail chain which ends a pattern, or None
+        self.output_link = [None]
+        for pattern in patterns:
+            self.add(pattern)
+        self.build()
+
+    def add(self, pattern):
+        if not pattern:
+            return
+        state = 0
+        for char in pattern:
+            next_state = self.goto[state].get(char)
+            if next_state is None:
+                next_state = len(self.goto)
+                self.goto[state][char] = next_state
+                self.goto.append({})
+                self.fail.append(0)
+                self.pattern.append(None)
+                self.output_link.append(None)
+            state = next_state
+        self.pattern[state] = pattern
+
+    def build(self):
+        # Breadth-first, so that the fail state of a state is computed after
+        # those of all shallower states.
+        queue = list(self.goto[0].values())
+        for state in queue:
+            for char, child in self.goto[state].items():
+                fail = self.fail[state]
+                while char not in self.goto[fail] and fail != 0:
+                    fail = self.fail[fail]
+                fail = self.goto[fail].get(char, 0)
+                self.fail[child] = fail
+                self.output_link[child] = (
+                    fail if self.pattern[fail] is not None
+                    else self.output_link[fail])
+                queue.append(child)
+
+    def find(self, text):
+        """Yields a triple (START, END, PATTERN) for each occurrence of a pattern
+        in TEXT, ordered by END."""
+        goto, fail = self.goto, self.fail
+        state = 0
+        for index, char in enumerate(text):
+            while char not in goto[state] and state != 0:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if self.pattern[state] is not None:
+                match = state
+            else:
+                match = self.output_link[state]
+            while match is not None:
+                pattern = self.pattern[match]
+                yield (index + 1 - len(pattern), index + 1, pattern)
+                match = self.output_link[match]
+
+# Duplicate index
+# ════════════════════════════════════════
+
+class DuplicateIndex:
+    """Maps the normalized first fields of the notes in the collection, per
+    notetype, to the ids of the notes which have them, so that duplicates can
+    be found without querying the collection. The normalization strips HTML,
+    whitespace differences and the {prefix} inserted by prefix_load, so notes
+    which differ only by their prefix are duplicates. The index is built in
+    the background and then kept up to date through the collection's hooks.
+    It is dropped, to be rebuilt on demand, when another collection is loaded
+    or an operation changes notes without going through those hooks (such as
+    an undo)."""
+
+    PREFIX_REGEX = re.compile(r"^\{[^}]*\}")
+    WHITESPACE_REGEX = re.compile(r"\s+")
+
+    def __init__(self):
+        # Maps a key (see SELF.KEY) to a set of note ids. None until built.
+        self.notes = None
+        # Maps a note id to its key
+        self.keys = {}
+        self.building = False
+        # Incremented when the index is dropped, so that a build which was
+        # running then is discarded.
+        self.generation = 0
+
+    def invalidate(self, *args):
+        self.notes = None
+        self.keys = {}
+        self.building = False
+        self.generation += 1
+
+    def on_operation_did_execute(self, changes, handler):
+        # The changes made by the editors and the Add windows are tracked
+        # through the hooks
+        if changes.note_text and not isinstance(
+                handler, (Editor, AddCards, AddCardsExtension)):
+            self.invalidate()
+
+    @classmethod
+    def key(cls, notetype_id, first_field):
+        text = unicodedata.normalize("NFC", strip_html_media(first_field))
+        text = cls.PREFIX_REGEX.sub("", text.strip())
+        text = cls.WHITESPACE_REGEX.sub(" ", text).strip()
+        if not text:
+            return None
+        return (notetype_id, hash(text))
+
+    def build(self):
+        if self.notes is not None or self.building:
+            return
+        self.building = True
+        def op(col):
+            return [(note_id, self.key(notetype_id, fields.split("\x1f", 1)[0]))
+                    for note_id, notetype_id, fields
+                    in col.db.execute("select id, mid, flds from notes")]
+        generation = self.generation
+        QueryOp(parent=mw, op=op,
+                success=lambda keys: self.build_done(generation, keys)
+                ).run_in_background()
+
+    def build_done(self, generation, keys):
+        if generation != self.generation:
+            return
+        self.notes = {}
+        self.keys = {}
+        for note_id, key in keys:
+            self.insert(note_id, key)
+        self.building = False
+
+    def insert(self, note_id, key):
+        if key is not None:
+            self.notes.setdefault(key, set()).add(note_id)
+            self.keys[note_id] = key
+
+    def remove(self, note_id):
+        key = self.keys.pop(note_id, None)
+        if key is not None:
+            note_ids = self.notes[key]
+            note_ids.discard(note_id)
+            if not note_ids:
+                del self.notes[key]
+
+    def update(self, note):
+        """Called after NOTE was added, or before it is saved"""
+        if self.notes is None or not note.id:
+            return
+        self.remove(note.id)
+        self.insert(note.id, self.key(note.mid, note.fields[0]))
+
+    def on_notes_will_be_deleted(self, col, note_ids):
+        if self.notes is not None:
+            for note_id in note_ids:
+                self.remove(note_id)
+
+    def duplicates(self, note):
+        """Returns the ids of the notes which duplicate NOTE, or None if the
+        index is not built yet (in which case the build is started)."""
+        if self.notes is None:
+            self.build()
+            return None
+        key = self.key(note.mid, note.fields[0])
+        return self.notes.get(key, set()) - {note.id}
+
+duplicate_index = DuplicateIndex()
+
+# Collection metadata
+# ════════════════════════════════════════
+
+class CollectionMetadata:
+    """The names and ids of the notetypes and decks of the collection, loaded
+    on demand and dropped whenever an operation changes notetypes or decks (or
+    another collection is loaded)."""
+
+    def __init__(self):
+        # Dicts mapping names to ids, and the sets of ids. None until loaded.
+        self.notetypes = self.notetype_ids = None
+        self.decks = self.deck_ids = None
+
+    def invalidate(self, *args):
+        self.notetypes = self.notetype_ids = None
+        self.decks = self.deck_ids = None
+
+    def on_operation_did_execute(self, changes, handler):
+        if changes.notetype:
+            self.notetypes = self.notetype_ids = None
+        if changes.deck:
+            self.decks = self.deck_ids = None
+
+    def load(self):
+        if self.notetypes is None:
+            self.notetypes = {entry.name: entry.id for entry
+                              in mw.col.models.all_names_and_ids()}
+            self.notetype_ids = set(self.notetypes.values())
+        if self.decks is None:
+            self.decks = {entry.name: entry.id for entry
+                          in mw.col.decks.all_names_and_ids()}
+            self.deck_ids = set(self.decks.values())
+
+    def notetype_id(self, name):
+        """Returns the id of the notetype named NAME, or None"""
+        self.load()
+        return self.notetypes.get(name)
+
+    def deck_id(self, name):
+        """Returns the id of the deck named NAME, or None"""
+        self.load()
+        return self.decks.get(name)
+
+    def notetype_exists(self, notetype_id):
+        self.load()
+        return notetype_id in self.notetype_ids
+
+    def deck_exists(self, deck_id):
+        self.load()
+        return deck_id in self.deck_ids
+
+collection_metadata = CollectionMetadata()
+
+# Command palette
+# ════════════════════════════════════════
+
+class CommandIndex:
+    """An index of the editor and Add window commands by the words of their
+    names and docstrings, for the command palette (see
+    EditorExtension.palette_show). It is built once at import, with the words
+    kept sorted so that the commands having a word which starts with a given
+    prefix are found by bisection. The number of times each command was run
+    from the palette is persisted, and ranks the matches."""
+
+    PATH = os.path.realpath(
+        os.path.join(os.path.dirname(__file__),
+                     "user_data", "command_usage.json"))
+    WORD_REGEX = re.compile(r"[a-z0-9]+")
+
+    def __init__(self):
+        # Sorted words, and for each one the set of commands having it. A
+        # command is a pair (KIND, NAME), where KIND is "editor" or
+        # "addcards".
+        self.words = []
+        self.postings = []
+        # Maps a command to the first line of its docstring
+        self.docs = {}
+        # Maps "KIND:NAME" to a count. Read lazily, on the first use.
+        self.usage = None
+
+    def build(self, sources):
+        """SOURCES maps a kind to a pair (CLASS, COMMANDS), where COMMANDS
+        is editor_commands or addcards_commands"""
+        index = {}
+        for kind, (cls, commands) in sources.items():
+            for name in commands:
+                command = (kind, name)
+                doc = inspect.getdoc(getattr(cls, name)) or ""
+                self.docs[command] = doc.split("\n")[0]
+                for word in self.WORD_REGEX.findall(f"{name} {doc}".lower()):
+                    index.setdefault(word, set()).add(command)
+        self.words = sorted(index)
+        self.postings = [index[word] for word in self.words]
+
+    def search(self, query, commands):
+        """Returns the commands among COMMANDS (a set) with a word starting
+        with each word of QUERY, the most used first"""
+        matches = set(commands)
+        for word in self.WORD_REGEX.findall(query.lower()):
+            start = bisect.bisect_left(self.words, word)
+            end = bisect.bisect_left(self.words, word + "\uffff", start)
+            matches &= set().union(*self.postings[start:end])
+            if not matches:
+                break
+        usage = self.get_usage()
+        return sorted(matches, key=lambda command: (
+            -usage.get(":".join(command), 0), command[1]))
+
+    def get_usage(self):
+        if self.usage is None:
+            try:
+                with open(self.PATH) as f:
+                    self.usage = json.load(f)
+            except FileNotFoundError:
+                self.usage = {}
+        return self.usage
+
+    def record(self, command):
+        usage = self.get_usage()
+        key = ":".join(command)
+        usage[key] = usage.get(key, 0) + 1
+        os.makedirs(os.path.dirname(self.PATH), exist_ok=True)
+        with open(self.PATH, "w") as f:
+            json.dump(usage, f)
+
+command_index = CommandIndex()
+
 # Editor
 # ════════════════════════════════════════
 
+# The extensions of all open editors
+editor_extensions = weakref.WeakSet()
+
 # editor_commands is a dict which maps a method name to
-# a pair [QKeySequence, QShortcut_or_None]
+# a pair [QKeySequence, enabled]
 editor_commands = {}
 def editor_command(key_seq_str):
     def decorator(func):
         # Bind to the function name instead of the function so that
         # different methods are created for different instances
-        editor_commands[func.__name__] = [QKeySequence(key_seq_str), None]
+        editor_commands[func.__name__] = [QKeySequence(key_seq_str), True]
+        @functools.wraps(func)
         def new_func(self):
+            self.macro_record_command(func.__name__)
             func(self)
-            if func.__name__ != "set_prefix_arg":
+            if func.__name__ not in EditorExtension.PREFIX_ARG_COMMANDS:
                 self.clear_prefix_arg()
         return new_func
     return decorator
@@ -112,16 +1000,26 @@ class EditorExtension(Extension):
         self.web = editor.web
         self.widget = editor.widget
         self.bindings = copy.deepcopy(bindings)
-        self.prefix_arg = False
+        self.prefix_arg = None
+        self.prefix_arg_digits = None
+        editor_extensions.add(self)
+        self.setup_lifecycle()
         self.disable_keys()
         self.setup_shortcuts()
         # setups
         # ════════════════════
         self.setup_js()
-        self.emacs_setup()
+        self.bridge_setup()
+        self.emacs_isearch_setup()
+        self.replace_setup()
         self.code_highlight_setup()
         self.misc_setup()
         self.identifiers_setup()
+        self.macro_setup()
+
+    def teardown(self, *args):
+        super().teardown()
+        editor_extensions.discard(self)
 
     # utils
     # ════════════════════════════════════════
@@ -141,6 +1039,44 @@ class EditorExtension(Extension):
         web_subwidget = self.web.findChildren(QWidget)[0]
         web_subwidget.removeEventFilter(event_filter)
 
+    # JS -> Python bridge. The Python side sends a request with an id, naming
+    # the values it needs out of bridge_getters (see editor_extensions.js). The
+    # JS side sends all of them back in a single message carrying the same id,
+    # which resolves the future returned to the requester.
+    # ════════════════════════════════════════
+
+    BRIDGE_PREFIX = "editor_extensions_bridge:"
+
+    def bridge_setup(self):
+        self.bridge_ids = itertools.count()
+        # Maps a request id to its future
+        self.bridge_pending = {}
+
+    def bridge_request(self, *names):
+        """Returns a concurrent.futures.Future which resolves to a dict mapping
+        each of NAMES to its value in the editor. From asyncio code, wrap it
+        with asyncio.wrap_future."""
+        request_id = next(self.bridge_ids)
+        future = Future()
+        self.bridge_pending[request_id] = future
+        self.pending_begin()
+        self.eval_js(f"bridge_request({request_id}, {json.dumps(names)})")
+        return future
+
+    def bridge_on_message(self, message):
+        reply = json.loads(message[len(self.BRIDGE_PREFIX):])
+        future = self.bridge_pending.pop(reply["id"], None)
+        if future is None:
+            return
+        try:
+            if reply["error"] is not None:
+                future.set_exception(RuntimeError(reply["error"]))
+            else:
+                future.set_result(reply["values"])
+        finally:
+            # After the callbacks of FUTURE, which run in set_result
+            self.pending_end()
+
     # disabling keys
     # ════════════════════════════════════════
     
@@ -181,30 +1117,168 @@ class EditorExtension(Extension):
             text = open(path).read()
             self.eval_js(text)
 
-    # Prefix arguments.
+    # Prefix arguments. As in Emacs, Ctrl+U sets SELF.PREFIX_ARG to 4 and each
+    # further Ctrl+U multiplies it by 4, while digits (and a leading "-") typed
+    # after Ctrl+U, or with Alt, set it to the number they form. Without a
+    # prefix argument, SELF.PREFIX_ARG is None. Commands which repeat use
+    # SELF.PREFIX_ARG_COUNT, and do the repetition in a single JavaScript call.
     # ════════════════════════════════════════
-    
+
+    # The commands which build the prefix argument, or pass it on, instead of
+    # consuming it
+    PREFIX_ARG_COMMANDS = {"set_prefix_arg", "prefix_arg_negative",
+                           "palette_show"} | {
+        f"prefix_arg_digit_{digit}" for digit in range(10)}
+
     def clear_prefix_arg(self):
-        self.prefix_arg = False
-        
+        self.prefix_arg = None
+        self.prefix_arg_digits = None
+        if hasattr(self, "prefix_arg_event_filter"):
+            self.remove_event_filter(self.prefix_arg_event_filter)
+            del self.prefix_arg_event_filter
+
+    def key_sequence_undefined(self):
+        self.clear_prefix_arg()
+
+    def command_dispatched(self, command_name):
+        # The commands of the Add window don't go through editor_command, so
+        # the prefix argument is cleared here too.
+        if command_name not in self.PREFIX_ARG_COMMANDS:
+            self.clear_prefix_arg()
+
+    def prefix_arg_count(self):
+        """Returns the number of times to repeat a command"""
+        return 1 if self.prefix_arg is None else self.prefix_arg
+
     @editor_command("Ctrl+U")
     def set_prefix_arg(self):
-        self.prefix_arg = True
-    
+        if self.prefix_arg_digits:
+            # Ctrl+U after digits ends the argument, as in Emacs
+            self.prefix_arg_digits = None
+        elif self.prefix_arg is None:
+            self.prefix_arg = 4
+            self.prefix_arg_digits = ""
+        else:
+            self.prefix_arg *= 4
+        self.prefix_arg_install_filter()
+        tooltip(f"C-u {self.prefix_arg}-")
+
+    def prefix_arg_install_filter(self):
+        if not hasattr(self, "prefix_arg_event_filter"):
+            self.prefix_arg_event_filter = self.prefix_arg_EventFilter(self)
+            self.install_event_filter(self.prefix_arg_event_filter)
+
+    def prefix_arg_add(self, char):
+        """Adds CHAR (a digit or "-") to the digits of the prefix
+        argument"""
+        digits = (self.prefix_arg_digits or "") + char
+        if char == "-" and digits != "-":
+            return False
+        self.prefix_arg_digits = digits
+        self.prefix_arg = -1 if digits == "-" else int(digits)
+        self.prefix_arg_install_filter()
+        tooltip(f"C-u {digits}-")
+        return True
+
+    @editor_command("Alt+0")
+    def prefix_arg_digit_0(self):
+        self.prefix_arg_add("0")
+
+    @editor_command("Alt+1")
+    def prefix_arg_digit_1(self):
+        self.prefix_arg_add("1")
+
+    @editor_command("Alt+2")
+    def prefix_arg_digit_2(self):
+        self.prefix_arg_add("2")
+
+    @editor_command("Alt+3")
+    def prefix_arg_digit_3(self):
+        self.prefix_arg_add("3")
+
+    @editor_command("Alt+4")
+    def prefix_arg_digit_4(self):
+        self.prefix_arg_add("4")
+
+    @editor_command("Alt+5")
+    def prefix_arg_digit_5(self):
+        self.prefix_arg_add("5")
+
+    @editor_command("Alt+6")
+    def prefix_arg_digit_6(self):
+        self.prefix_arg_add("6")
+
+    @editor_command("Alt+7")
+    def prefix_arg_digit_7(self):
+        self.prefix_arg_add("7")
+
+    @editor_command("Alt+8")
+    def prefix_arg_digit_8(self):
+        self.prefix_arg_add("8")
+
+    @editor_command("Alt+9")
+    def prefix_arg_digit_9(self):
+        self.prefix_arg_add("9")
+
+    @editor_command("Alt+-")
+    def prefix_arg_negative(self):
+        self.prefix_arg_add("-")
+
+    class prefix_arg_EventFilter(QObject):
+        """Installed by Ctrl+U. Reads the digits of the prefix argument, and
+        repeats the next typed character or Backspace. Keys which invoke
+        commands clear the prefix argument through the editor_command
+        decorator, and so remove this filter, without reaching it."""
+        def __init__(self, ext):
+            super().__init__()
+            self.ext = ext
+
+        def eventFilter(self, obj, event):
+            if event.type() != QEvent.KeyPress:
+                return False
+            key, modifiers, text = event.key(), event.modifiers(), event.text()
+            if key in ChordDispatcher.MODIFIER_KEYS:
+                return False
+            ext = self.ext
+            count = ext.prefix_arg_count()
+            if modifiers & (Qt.ControlModifier | Qt.AltModifier |
+                            Qt.MetaModifier):
+                ext.clear_prefix_arg()
+                return False
+            if ext.prefix_arg_digits is not None and (
+                    text.isdigit() or text == "-"):
+                if ext.prefix_arg_add(text):
+                    return True
+            ext.clear_prefix_arg()
+            if key == Qt.Key_Backspace and count > 0:
+                ext.eval_js(f"emacs_delete({count})")
+                if ext.macro_recording:
+                    ext.macro_steps.extend([("delete",)] * count)
+                return True
+            if text and text.isprintable() and count > 0:
+                ext.eval_js(f'document.execCommand("insertText", false, '
+                            f'{json.dumps(text * count)});')
+                if ext.macro_recording:
+                    ext.macro_record_text(text * count)
+                return True
+            return False
+
     # codify
     # ════════════════════════════════════════
 
     @editor_command("Ctrl+C")
     def codify_preceding_bold(self):
-        if self.prefix_arg:
+        if self.prefix_arg is not None:
             self.eval_js('swap_preceding_type("CODE", "B");')
         else:
             self.eval_js('swap_preceding_type("B", "CODE");')
             
     @editor_command("Ctrl+X, C")
     def codify_selection(self):
-        web = self.web
-        selected_text = web.selectedText()
+        self.bridge_request("selection_text").add_done_callback(
+            lambda future: self.codify_text(future.result()["selection_text"]))
+
+    def codify_text(self, selected_text):
         # after this IF statement, CODIFIED will store the text to insert
         if selected_text:
             selected_text = html.escape(selected_text)
@@ -232,18 +1306,18 @@ class EditorExtension(Extension):
     # too many conflicts.
     # ════════════════════════════════════════
     
-    def emacs_setup(self):
-        self.emacs_extend_selection_next_time = False
-
     def emacs_save_point(self):
         self.eval_js("emacs_save_point()")
     def emacs_restore_point(self):
         self.eval_js("emacs_restore_point()")
 
-    @property
     def emacs_mark_is_active(self):
-        return (self.emacs_extend_selection_next_time or
-                self.web.hasSelection())
+        """Returns a future (see SELF.BRIDGE_REQUEST) resolving to whether the
+        next movement command will extend the selection."""
+        future = Future()
+        self.bridge_request("mark_active").add_done_callback(
+            lambda request: future.set_result(request.result()["mark_active"]))
+        return future
         
     @editor_command("Ctrl+Space")
     def emacs_set_extend_flag(self):
@@ -252,16 +1326,18 @@ class EditorExtension(Extension):
     def emacs_unset_mark(self):
         self.eval_js("emacs_unset_extend_flag()")
 
-    def emacs_move(self, direction, unit):
+    def emacs_move(self, direction, unit, count=1):
+        """Moves COUNT times by UNIT, in the opposite direction if COUNT is
+        negative"""
         direction, unit = map(json.dumps, (direction, unit))
-        self.eval_js(f"emacs_move({direction}, {unit})")
+        self.eval_js(f"emacs_move({direction}, {unit}, {count})")
         
     def emacs_collapse_selection(self):
         self.eval_js("emacs_selection().collapse_to_focus()")
 
     @editor_command("Ctrl+X, H")
     def emacs_mark_all(self):
-        self.web.triggerPageAction(QWebEnginePage.SelectAll)
+        self.trigger_page_action(QWebEnginePage.SelectAll)
 
     @editor_command("Ctrl+A")
     def emacs_beginning_of_line(self):
@@ -275,27 +1351,27 @@ class EditorExtension(Extension):
         
     @editor_command("Alt+F")
     def emacs_forward_word(self):
-        self.emacs_move("forward", "word")
+        self.emacs_move("forward", "word", self.prefix_arg_count())
         
     @editor_command("Alt+B")
     def emacs_backward_word(self):
-        self.emacs_move("backward", "word")
+        self.emacs_move("backward", "word", self.prefix_arg_count())
 
     @editor_command("Ctrl+F")
     def emacs_forward_char(self):
-        self.emacs_move("forward", "character")
+        self.emacs_move("forward", "character", self.prefix_arg_count())
 
     @editor_command("Ctrl+B")
     def emacs_backward_char(self):
-        self.emacs_move("backward", "character")
+        self.emacs_move("backward", "character", self.prefix_arg_count())
 
     @editor_command("Ctrl+N")
     def emacs_next_line(self):
-        self.emacs_move("forward", "line")
+        self.emacs_move("forward", "line", self.prefix_arg_count())
 
     @editor_command("Ctrl+P")
     def emacs_previous_line(self):
-        self.emacs_move("backward", "line")
+        self.emacs_move("backward", "line", self.prefix_arg_count())
 
     @editor_command("Alt+<")
     def emacs_goto_beginning(self):
@@ -309,19 +1385,59 @@ class EditorExtension(Extension):
     def emacs_quit(self):
         self.emacs_unset_mark()
 
+    # Killing and yanking go through the kill ring (see KillRing) instead of
+    # the system clipboard.
     @editor_command("Ctrl+W")
     def emacs_kill_region(self):
-        self.web.triggerPageAction(QWebEnginePage.Cut)
+        self.eval_js_with_callback("killring_selection(true)",
+                                   self.emacs_kill_callback)
 
     @editor_command("Alt+W")
     def emacs_copy(self):
-        self.web.triggerPageAction(QWebEnginePage.Copy)
+        self.eval_js_with_callback("killring_selection(false)",
+                                   self.emacs_kill_callback)
         self.emacs_collapse_selection()
 
+    def emacs_kill_callback(self, killed):
+        if killed:
+            kill_ring.push(killed["html"], killed["text"])
+
     @editor_command("Ctrl+Y")
     def emacs_yank(self):
+        if not kill_ring.entries:
+            # Nothing was killed yet, fall back to the system clipboard.
+            kill_ring.import_clipboard()
+        entry = kill_ring.current()
+        if entry is None:
+            tooltip("Kill ring is empty")
+            return
         self.emacs_save_point()
-        self.web.triggerPageAction(QWebEnginePage.Paste)
+        html = json.dumps(self.emacs_yank_html(entry))
+        self.eval_js(f"killring_yank({html})")
+
+    @editor_command("Alt+Y")
+    def emacs_yank_pop(self):
+        entry = kill_ring.next_entry()
+        if entry is None:
+            tooltip("Kill ring is empty")
+            return
+        html = json.dumps(self.emacs_yank_html(entry))
+        self.eval_js_with_callback(f"killring_yank_pop({html})",
+                                   self.emacs_yank_pop_callback)
+
+    def emacs_yank_pop_callback(self, replaced):
+        if replaced:
+            kill_ring.rotate()
+        else:
+            tooltip("Previous command was not a yank")
+
+    def emacs_yank_html(self, entry):
+        """Returns the HTML of ENTRY (of kill_ring) to insert. The HTML
+        imported from other applications goes through the paste filter of the
+        editor, as with a regular paste."""
+        if kill_ring.is_imported(entry):
+            return self.editor._pastePreFilter(entry[0], False)
+        return entry[0]
 
     @editor_command("Ctrl+X, Ctrl+X")
     def emacs_restore_point_cmd(self):
@@ -330,37 +1446,160 @@ class EditorExtension(Extension):
     # ════════════════════════════════════════
     # emacs_search
     
-    def emacs_search(self, substr, direction):
+    def emacs_search(self, substr, direction, regexp=False):
         substr, direction = json.dumps(substr), json.dumps(direction)
-        self.eval_js(f"emacs_search({substr}, {direction})")
+        function = "emacs_search_regexp" if regexp else "emacs_search"
+        self.eval_js(f"{function}({substr}, {direction})")
 
     @editor_command("Ctrl+S")
     def emacs_isearch_forward(self):
         self.emacs_isearch_direction = "forward"
+        self.emacs_isearch_regexp = False
         self.emacs_isearch_mode()
 
     @editor_command("Ctrl+R")
     def emacs_isearch_backward(self):
         self.emacs_isearch_direction = "backward"
+        self.emacs_isearch_regexp = False
         self.emacs_isearch_mode()
 
-    def emacs_isearch_mode(self):
+    @editor_command("Ctrl+Alt+S")
+    def emacs_isearch_regexp_forward(self):
+        """Searches incrementally for a regexp. Patterns with a quantified
+        group containing a quantifier or an alternation are refused, but
+        other catastrophic patterns can still freeze the editor."""
+        self.emacs_isearch_direction = "forward"
+        self.emacs_isearch_regexp = True
+        self.emacs_isearch_mode()
+
+    @editor_command("Ctrl+Alt+R")
+    def emacs_isearch_regexp_backward(self):
+        self.emacs_isearch_direction = "backward"
+        self.emacs_isearch_regexp = True
+        self.emacs_isearch_mode()
+
+    # Searches are dispatched at most once per this many milliseconds (about a
+    # frame), so that fast typing doesn't queue a search per character.
+    EMACS_ISEARCH_DISPATCH_INTERVAL = 16
+
+    def emacs_isearch_setup(self):
+        # The isearch bar is created once and only shown while searching, to
+        # avoid a relayout of the editor on every search.
         edit = self.emacs_isearch_line_edit = QLineEdit()
-        self.editor.outerLayout.insertWidget(1, edit)
         edit.setReadOnly(True)
+        edit.hide()
+        self.editor.outerLayout.insertWidget(1, edit)
+        timer = self.emacs_isearch_timer = QTimer(self.widget)
+        timer.setSingleShot(True)
+        timer.setInterval(self.EMACS_ISEARCH_DISPATCH_INTERVAL)
+        qconnect(timer.timeout, self.emacs_isearch_dispatch)
+        # Pairs (HTML, TEXT) for the fields of the note, where TEXT is HTML
+        # stripped and lowercased, used to find the next field to search
+        # without scanning the fields in the webview.
+        self.emacs_isearch_field_cache = []
+        self.add_hook(gui_hooks.editor_did_load_note,
+                      self.emacs_isearch_on_load_note)
+        self.add_hook(gui_hooks.editor_did_fire_typing_timer,
+                      self.emacs_isearch_on_field_change)
+        self.add_hook(gui_hooks.editor_did_unfocus_field,
+                      self.emacs_isearch_on_unfocus_field)
+
+    def emacs_isearch_on_load_note(self, editor):
+        if editor is self.editor:
+            self.emacs_isearch_field_cache = []
+            self.emacs_isearch_field_texts()
+
+    def emacs_isearch_on_field_change(self, note):
+        if note is self.editor.note:
+            self.emacs_isearch_field_texts()
+
+    def emacs_isearch_on_unfocus_field(self, changed, note, ord):
+        if note is self.editor.note:
+            self.emacs_isearch_field_texts()
+        return changed
+
+    def emacs_isearch_field_texts(self):
+        """Returns the stripped and lowercased text of each field of the note,
+        stripping again only the fields which changed since the last call"""
+        cache = self.emacs_isearch_field_cache
+        fields = self.editor.note.fields if self.editor.note else []
+        if len(cache) != len(fields):
+            cache[:] = [(None, "")] * len(fields)
+        for index, field_html in enumerate(fields):
+            if cache[index][0] != field_html:
+                cache[index] = (field_html, strip_html(field_html).lower())
+        return [text for _, text in cache]
+
+    def emacs_isearch_mode(self):
+        edit = self.emacs_isearch_line_edit
+        edit.clear()
+        edit.setPlaceholderText(
+            "Regexp I-search" if self.emacs_isearch_regexp else "I-search")
+        edit.show()
         event_filter = self.emacs_isearch_event_filter = (
             self.emacs_isearch_EventFilter(self))
         self.install_event_filter(event_filter)
 
+    def emacs_isearch_schedule(self):
+        """Searches for the text of the isearch bar from the point where the
+        search began, once the current dispatch interval ends."""
+        if not self.emacs_isearch_timer.isActive():
+            self.emacs_isearch_timer.start()
+
+    def emacs_isearch_flush(self):
+        """Dispatches the scheduled search, if any, right away"""
+        if self.emacs_isearch_timer.isActive():
+            self.emacs_isearch_timer.stop()
+            self.emacs_isearch_dispatch()
+
+    def emacs_isearch_dispatch(self):
+        text = self.emacs_isearch_line_edit.text()
+        direction = self.emacs_isearch_direction
+        regexp = self.emacs_isearch_regexp
+        self.eval_js_with_callback(
+            f"emacs_isearch_update({json.dumps(text)}, {json.dumps(direction)}, "
+            f"{json.dumps(regexp)})",
+            functools.partial(self.emacs_isearch_other_field, text, direction))
+
+    def emacs_isearch_other_field(self, text, direction, result):
+        """Continues a search for TEXT which failed in the current field in the
+        next field in DIRECTION which contains TEXT. RESULT is the pair
+        (FOUND, FIELD_INDEX) returned by the JavaScript search."""
+        if (not result or result[0] or result[1] is None or
+                self.emacs_isearch_regexp or
+                not hasattr(self, "emacs_isearch_event_filter") or
+                self.emacs_isearch_line_edit.text() != text):
+            # Found, or the search is no longer current
+            return
+        texts = self.emacs_isearch_field_texts()
+        field_index = result[1]
+        if direction == "forward":
+            indexes = range(field_index + 1, len(texts))
+        else:
+            indexes = range(field_index - 1, -1, -1)
+        query = text.lower()
+        for index in indexes:
+            if query in texts[index]:
+                # The text of the webview may still not match (e.g. when it
+                # is split by tags), in which case the search continues from
+                # that field.
+                self.eval_js_with_callback(
+                    f"emacs_isearch_enter_field({index}, {json.dumps(text)}, "
+                    f"{json.dumps(direction)})",
+                    functools.partial(self.emacs_isearch_other_field,
+                                      text, direction))
+                return
+
     class emacs_isearch_EventFilter(QObject):
         def __init__(self, ext):
             super().__init__()
             self.ext = ext
             self.edit = ext.emacs_isearch_line_edit
-            self.ext.emacs_save_point()
+            self.ext.eval_js("emacs_isearch_start()")
             self.conflicting_commands = [
                 "emacs_quit", "emacs_isearch_forward",
-                "emacs_isearch_backward"
+                "emacs_isearch_backward", "emacs_isearch_regexp_forward",
+                "emacs_isearch_regexp_backward"
             ]
             self.disable_conflicting_commands()
 
@@ -379,13 +1618,24 @@ class EditorExtension(Extension):
                             self.accept()
                             return False
                     return True
+                elif modifiers == Qt.ControlModifier | Qt.AltModifier:
+                    # Repeats a regexp isearch, as Ctrl+S/R do
+                    if key == Qt.Key_S:
+                        self.move("forward")
+                    elif key == Qt.Key_R:
+                        self.move("backward")
+                    return True
+                elif modifiers & (Qt.ControlModifier | Qt.AltModifier |
+                                  Qt.MetaModifier):
+                    return True
                 else:
+                    text = event.text()
                     if key == Qt.Key_Return:
                         self.accept()
                     elif key == Qt.Key_Backspace:
                         self.delete()
-                    else:
-                        self.insert(event.text())
+                    elif text and text.isprintable():
+                        self.insert(text)
                     return True
             else:
                 return False
@@ -399,45 +1649,476 @@ class EditorExtension(Extension):
                 self.ext.enable_command(command)
 
         def cleanup(self):
-            self.edit.setParent(None)
+            self.edit.hide()
             self.ext.remove_event_filter(self)
             del self.ext.emacs_isearch_event_filter
             self.enable_conflicting_commands()
 
         def accept(self):
+            self.ext.emacs_isearch_flush()
             self.cleanup()
 
         def reject(self):
-            self.ext.emacs_restore_point()
+            self.ext.emacs_isearch_timer.stop()
+            self.ext.eval_js("emacs_isearch_cancel()")
             self.cleanup()
 
         def delete(self):
             text = self.edit.text()
             if text:
-                new_text = text[:-1]
-                self.edit.setText(new_text)
-                self.ext.emacs_restore_point()
-                self.ext.emacs_search(
-                    new_text, self.ext.emacs_isearch_direction)
+                self.edit.setText(text[:-1])
+                self.ext.emacs_isearch_schedule()
         
         def insert(self, char):
-            new_text = self.edit.text() + char
-            self.edit.setText(new_text)
-            self.ext.emacs_restore_point()
-            self.ext.emacs_search(
-                new_text, self.ext.emacs_isearch_direction)
+            self.edit.setText(self.edit.text() + char)
+            self.ext.emacs_isearch_schedule()
 
         def move(self, direction):
+            self.ext.emacs_isearch_flush()
             text = self.edit.text()
             if text:
-                self.ext.emacs_search(text, direction)
+                self.ext.eval_js_with_callback(
+                    f"emacs_isearch_move({json.dumps(text)}, "
+                    f"{json.dumps(direction)}, "
+                    f"{json.dumps(self.ext.emacs_isearch_regexp)})",
+                    functools.partial(self.ext.emacs_isearch_other_field,
+                                      text, direction))
+
+    # ════════════════════════════════════════
+    # Query replace across all the fields of the note. The matches are found
+    # once, in the text (not the tags) of each field, and are then stepped
+    # through in order. The accepted replacements are applied at the end, with
+    # each changed field rebuilt in a single pass and the note reloaded once.
+
+    # Characters of context shown on each side of the current match
+    REPLACE_CONTEXT = 30
+
+    def replace_setup(self):
+        # Created once, like the isearch bar
+        edit = self.replace_line_edit = QLineEdit()
+        edit.setReadOnly(True)
+        edit.hide()
+        self.editor.outerLayout.insertWidget(1, edit)
+
+    @editor_command("Alt+%")
+    def replace_query(self):
+        """Replaces occurrences of a string in all fields, asking for each"""
+        self.editor.call_after_note_saved(self.replace_query_saved)
+
+    def replace_query_saved(self):
+        query, accepted = QInputDialog.getText(None, "", "Query replace: ")
+        if not accepted or not query:
+            return
+        replacement, accepted = QInputDialog.getText(
+            None, "", f"Query replace {query} with: ")
+        if not accepted:
+            return
+        # The fields are searched with their entities decoded (see HtmlText),
+        # so only the replacement needs to be escaped.
+        replacement = html.escape(replacement, quote=False)
+        tokens, matches = self.replace_find(self.editor.note.fields, query)
+        if not matches:
+            tooltip("No matches")
+            return
+        event_filter = self.replace_event_filter = self.replace_EventFilter(
+            self, self.editor.note, tokens, matches, replacement)
+        self.install_event_filter(event_filter)
+
+    @staticmethod
+    def replace_find(fields, query):
+        """Returns a pair (TOKENS, MATCHES). TOKENS has, for each field, the
+        list of its tokens (see html_tokens), with the text tokens as HtmlText
+        objects. MATCHES is a list of tuples (FIELD_INDEX, TOKEN_INDEX, START,
+        END), with offsets into the decoded text, in the order of the note."""
+        query = query.replace("\xa0", " ").lower()
+        tokens = []
+        matches = []
+        for field_index, field_html in enumerate(fields):
+            field_tokens = html_tokens(field_html)
+            for token_index in range(0, len(field_tokens), 2):
+                html_text = field_tokens[token_index] = HtmlText(
+                    field_tokens[token_index])
+                text = html_text.text
+                lowered = text.lower()
+                if len(lowered) != len(text):
+                    # Offsets in LOWERED would not be valid in TEXT
+                    lowered = text
+                start = lowered.find(query)
+                while start != -1:
+                    end = start + len(query)
+                    matches.append((field_index, token_index, start, end))
+                    start = lowered.find(query, end)
+            tokens.append(field_tokens)
+        return tokens, matches
+
+    @staticmethod
+    def replace_apply(tokens, matches, replacement):
+        """Returns a dict from field index to the new HTML of that field, for
+        the fields with at least one of MATCHES. REPLACEMENT is HTML."""
+        by_token = {}
+        for field_index, token_index, start, end in matches:
+            by_token.setdefault((field_index, token_index), []).append(
+                (start, end))
+        fields = {}
+        for field_index, token_index in by_token:
+            fields[field_index] = [token if isinstance(token, str) else
+                                   token.raw for token in tokens[field_index]]
+        for (field_index, token_index), spans in by_token.items():
+            html_text = tokens[field_index][token_index]
+            raw = html_text.raw
+            pieces = []
+            position = 0
+            for start, end in spans:
+                pieces.append(raw[position:html_text.raw_offset(start)])
+                pieces.append(replacement)
+                position = html_text.raw_offset(end)
+            pieces.append(raw[position:])
+            fields[field_index][token_index] = "".join(pieces)
+        return {field_index: "".join(field_tokens)
+                for field_index, field_tokens in fields.items()}
+
+    class replace_EventFilter(QObject):
+        def __init__(self, ext, note, tokens, matches, replacement):
+            super().__init__()
+            self.ext = ext
+            # The note and its fields when the matches were found, to make
+            # sure that the replacements are applied to the same text
+            self.note = note
+            self.fields = note.fields[:]
+            self.edit = ext.replace_line_edit
+            self.tokens = tokens
+            self.matches = matches
+            self.replacement = replacement
+            self.position = 0
+            self.accepted = []
+            self.conflicting_commands = ["emacs_quit", "replace_query"]
+            for command in self.conflicting_commands:
+                self.ext.disable_command(command)
+            self.edit.show()
+            self.show_match()
+
+        # Events which could edit the fields while replacing
+        BLOCKED_EVENTS = (QEvent.InputMethod, QEvent.Drop)
+
+        def eventFilter(self, obj, event):
+            if event.type() in self.BLOCKED_EVENTS:
+                return True
+            if event.type() != QEvent.KeyPress:
+                return False
+            key, text = event.key(), event.text()
+            if text in ("y", " "):
+                self.next(accept=True)
+            elif text == "n" or key in (Qt.Key_Backspace, Qt.Key_Delete):
+                self.next(accept=False)
+            elif text == "!":
+                self.accepted.extend(self.matches[self.position:])
+                self.finish()
+            elif text == ".":
+                self.accepted.append(self.matches[self.position])
+                self.finish()
+            elif (text == "q" or key in (Qt.Key_Return, Qt.Key_Escape) or
+                  (key == Qt.Key_G and
+                   event.modifiers() == Qt.ControlModifier)):
+                self.finish()
+            return True
+
+        def show_match(self):
+            field_index, token_index, start, end = self.matches[self.position]
+            text = self.tokens[field_index][token_index].text
+            context = self.ext.REPLACE_CONTEXT
+            before = text[max(0, start - context):start]
+            match = text[start:end]
+            after = text[end:end + context]
+            field_name = self.ext.editor.note.keys()[field_index]
+            self.edit.setText(
+                f"Replace? (y/n/!/./q) [{self.position + 1}/"
+                f"{len(self.matches)}] {field_name}: "
+                f"…{before}[{match}]{after}…")
+
+        def next(self, accept):
+            if accept:
+                self.accepted.append(self.matches[self.position])
+            self.position += 1
+            if self.position < len(self.matches):
+                self.show_match()
+            else:
+                self.finish()
+
+        def finish(self):
+            self.edit.hide()
+            self.ext.remove_event_filter(self)
+            del self.ext.replace_event_filter
+            for command in self.conflicting_commands:
+                self.ext.enable_command(command)
+            if self.accepted:
+                # Make sure that note.fields has any edit done meanwhile
+                self.ext.editor.call_after_note_saved(self.apply)
+
+        def apply(self):
+            note = self.ext.editor.note
+            if note is not self.note or note.fields != self.fields:
+                tooltip("The note changed while replacing, nothing replaced")
+                return
+            fields = self.ext.replace_apply(
+                self.tokens, self.accepted, self.replacement)
+            for field_index, field_html in fields.items():
+                note.fields[field_index] = field_html
+            self.ext.editor.set_note(note)
+            count = len(self.accepted)
+            tooltip(f"Replaced {count} occurrence{'s' if count != 1 else ''}")
+
+    # ════════════════════════════════════════
+    # Keyboard macros. While recording, the invoked commands (along with their
+    # prefix arguments) and the typed text are stored as a list of steps. A
+    # replay runs the steps with the JavaScript batched (see
+    # Extension.begin_js_batch), so that each iteration is a single evaluation,
+    # except that a command waiting for the webview (see
+    # Extension.after_pending) ends the batch, and the next steps wait for it.
+
+    # Commands which control the recording and are never recorded themselves.
+    MACRO_COMMANDS = {"macro_start", "macro_stop_or_replay", "macro_replay",
+                      "macro_replay_per_note"}
+
+    def macro_setup(self):
+        self.macro_recording = False
+        self.macro_steps = []
+        self.macro_note_ids = []
+
+    def macro_record_command(self, command_name):
+        if (self.macro_recording and command_name not in self.MACRO_COMMANDS
+                and command_name not in self.PREFIX_ARG_COMMANDS):
+            self.macro_steps.append(("command", command_name, self.prefix_arg))
+
+    def macro_record_text(self, text):
+        # Coalesce consecutive characters into a single step.
+        if self.macro_steps and self.macro_steps[-1][0] == "insert":
+            text = self.macro_steps.pop()[1] + text
+        self.macro_steps.append(("insert", text))
+
+    @editor_command("F3")
+    def macro_start(self):
+        if self.macro_recording:
+            tooltip("Already defining a macro")
+            return
+        self.macro_steps = []
+        self.macro_recording = True
+        self.macro_event_filter = self.macro_EventFilter(self)
+        self.install_event_filter(self.macro_event_filter)
+        tooltip("Defining a macro...")
+
+    def macro_stop(self):
+        self.macro_recording = False
+        self.remove_event_filter(self.macro_event_filter)
+        del self.macro_event_filter
+        tooltip(f"Macro defined ({len(self.macro_steps)} steps)")
+
+    @editor_command("F4")
+    def macro_stop_or_replay(self):
+        if self.macro_recording:
+            self.macro_stop()
+        else:
+            self.macro_replay()
+
+    @editor_command("Ctrl+X, E")
+    def macro_replay(self):
+        """Replays the last macro, as many times as the prefix argument"""
+        if self.macro_recording:
+            self.macro_stop()
+        if not self.macro_steps:
+            tooltip("No macro is defined")
+            return
+        self.macro_replay_times(self.macro_steps, self.prefix_arg_count())
+
+    def macro_replay_times(self, steps, count, done=None):
+        """Replays STEPS COUNT times, then calls DONE"""
+        while count > 0:
+            count -= 1
+            rest = functools.partial(self.macro_replay_times, steps, count, done)
+            if not self.macro_replay_steps(steps, rest):
+                return
+        if done is not None:
+            done()
+
+    def macro_replay_steps(self, steps, done, start=0):
+        """Replays STEPS from START. Returns True if they all ran. Otherwise a
+        command is waiting for the webview (like the kill commands, or those
+        using the bridge), and the rest of the steps, followed by DONE, run
+        once it is answered."""
+        self.begin_js_batch()
+        try:
+            for index in range(start, len(steps)):
+                step = steps[index]
+                if step[0] == "command":
+                    _, command_name, prefix_arg = step
+                    self.prefix_arg = prefix_arg
+                    getattr(self, command_name)()
+                    if self.pending_count:
+                        self.after_pending(functools.partial(
+                            self.macro_replay_rest, steps, done, index + 1))
+                        return False
+                elif step[0] == "insert":
+                    text = json.dumps(step[1])
+                    self.eval_js(
+                        f'document.execCommand("insertText", false, {text});')
+                elif step[0] == "delete":
+                    self.eval_js('document.execCommand("delete");')
+        finally:
+            self.end_js_batch()
+        return True
+
+    def macro_replay_rest(self, steps, done, start):
+        if self.macro_replay_steps(steps, done, start):
+            done()
+
+    @editor_command("Ctrl+X, K, N")
+    def macro_replay_per_note(self):
+        """Replays the last macro once for each note selected in the Browser
+        which owns this editor."""
+        browser = self.editor.parentWindow
+        if not isinstance(browser, Browser):
+            tooltip("Not in the Browser")
+            return
+        if not self.macro_steps:
+            tooltip("No macro is defined")
+            return
+        self.macro_original_note_id = self.editor.note.id
+        self.macro_note_ids = list(browser.selected_notes())
+        self.macro_replay_next_note()
+
+    def macro_replay_next_note(self):
+        if not self.macro_note_ids:
+            self.editor.set_note(mw.col.get_note(self.macro_original_note_id))
+            tooltip("Macro replayed")
+            return
+        note = mw.col.get_note(self.macro_note_ids.pop(0))
+        self.editor.set_note(note, focusTo=0)
+        # Saving the note makes the changes done by the macro reach the
+        # collection before moving on.
+        self.macro_replay_times(self.macro_steps, 1, lambda:
+            self.editor.call_after_note_saved(self.macro_replay_next_note))
+
+    class macro_EventFilter(QObject):
+        """Records the text typed while a macro is being defined. Keys which
+        invoke commands are recorded through the editor_command decorator
+        instead, as they never reach this filter."""
+        def __init__(self, ext):
+            super().__init__()
+            self.ext = ext
+
+        def eventFilter(self, obj, event):
+            if event.type() == QEvent.KeyPress:
+                key, modifiers = event.key(), event.modifiers()
+                if modifiers & (Qt.ControlModifier | Qt.AltModifier |
+                                Qt.MetaModifier):
+                    return False
+                if key == Qt.Key_Backspace:
+                    self.ext.macro_steps.append(("delete",))
+                elif key in (Qt.Key_Return, Qt.Key_Enter):
+                    self.ext.macro_record_text("\n")
+                elif event.text() and event.text().isprintable():
+                    self.ext.macro_record_text(event.text())
+            return False
+
+    # ════════════════════════════════════════
+    # Command palette. The commands are looked up in command_index (see
+    # CommandIndex) and invoked like their key sequences would, so the prefix
+    # argument (which palette_show passes on) and the macro recording apply.
+
+    # Maximum number of matches listed
+    PALETTE_MAX_MATCHES = 50
+
+    @editor_command("Alt+X")
+    def palette_show(self):
+        """Runs a command chosen by name"""
+        targets = {"editor": self}
+        addcards_ext = next((ext for ext in addcards_extensions
+                             if ext.editor is self.editor), None)
+        if addcards_ext is not None:
+            targets["addcards"] = addcards_ext
+        dialog = self.palette_Dialog(self, targets)
+        command = dialog.choose()
+        if command is None:
+            self.clear_prefix_arg()
+            return
+        command_index.record(command)
+        kind, name = command
+        self.web.setFocus()
+        getattr(targets[kind], name)()
+        if name not in self.PREFIX_ARG_COMMANDS:
+            self.clear_prefix_arg()
+
+    class palette_Dialog(QDialog):
+        def __init__(self, ext, targets):
+            super().__init__(ext.editor.parentWindow)
+            self.ext = ext
+            self.targets = targets
+            # The enabled commands of TARGETS (including those unbound in
+            # key_bindings.json), and their key sequences
+            self.commands = set()
+            self.key_seqs = {}
+            for kind, target in targets.items():
+                for name, (key_seq, enabled) in target.bindings.items():
+                    if not enabled or (kind, name) == ("editor",
+                                                       "palette_show"):
+                        continue
+                    self.commands.add((kind, name))
+                    if key_seq is not None:
+                        self.key_seqs[(kind, name)] = key_seq.toString()
+            self.setWindowTitle("M-x")
+            self.edit = QLineEdit()
+            self.list = QListWidget()
+            layout = QVBoxLayout(self)
+            layout.addWidget(self.edit)
+            layout.addWidget(self.list)
+            qconnect(self.edit.textChanged, self.update_matches)
+            qconnect(self.edit.returnPressed, self.accept)
+            qconnect(self.list.itemActivated, lambda item: self.accept())
+            self.resize(600, 400)
+            self.update_matches("")
+
+        def update_matches(self, text):
+            self.list.clear()
+            matches = command_index.search(text, self.commands)
+            for command in matches[:self.ext.PALETTE_MAX_MATCHES]:
+                label = command[1]
+                if command in self.key_seqs:
+                    label += f"  ({self.key_seqs[command]})"
+                if command_index.docs[command]:
+                    label += f"  {command_index.docs[command]}"
+                item = QListWidgetItem(label)
+                item.setData(Qt.UserRole, command)
+                self.list.addItem(item)
+            self.list.setCurrentRow(0)
+
+        def keyPressEvent(self, event):
+            if event.key() in (Qt.Key_Up, Qt.Key_Down):
+                step = -1 if event.key() == Qt.Key_Up else 1
+                row = self.list.currentRow() + step
+                if 0 <= row < self.list.count():
+                    self.list.setCurrentRow(row)
+            elif (event.key() == Qt.Key_G and
+                  event.modifiers() == Qt.ControlModifier):
+                self.reject()
+            else:
+                super().keyPressEvent(event)
+
+        def choose(self):
+            """Returns the chosen command, or None"""
+            if not self.exec() or self.list.currentItem() is None:
+                return None
+            return tuple(self.list.currentItem().data(Qt.UserRole))
 
     # ════════════════════════════════════════
     # misc commands
 
     def misc_setup(self):
-        self.misc_python_history = []
-        self.misc_js_history = []
+        # The globals with which the Python code of misc_run_Python is
+        # evaluated, kept so that definitions persist across evaluations. It
+        # starts as a copy of the addon's globals, and there are no separate
+        # locals, so functions defined there can see each other.
+        self.misc_python_namespace = {
+            **globals(), "__builtins__": builtins, "ext": self,
+            "print": self.misc_PythonEdit.console_print}
         # ════════════════════
         # class EventFilter(QObject):
         #     def eventFilter(self, obj, event):
@@ -452,15 +2133,15 @@ class EditorExtension(Extension):
         # Since now I'm using Ctrl+B for something different, I want to change the
         # bold key. But for symmetry I also want to change the italic and underline
         # keys.        
-        self.web.triggerPageAction(QWebEnginePage.ToggleBold)
+        self.trigger_page_action(QWebEnginePage.ToggleBold)
 
     @editor_command("Ctrl+2")
     def misc_toggle_italic(self):
-        self.web.triggerPageAction(QWebEnginePage.ToggleItalic)
+        self.trigger_page_action(QWebEnginePage.ToggleItalic)
 
     @editor_command("Ctrl+3")
     def misc_toggle_underline(self):
-        self.web.triggerPageAction(QWebEnginePage.ToggleUnderline)
+        self.trigger_page_action(QWebEnginePage.ToggleUnderline)
 
     @editor_command("Ctrl+4")
     def misc_toggle_bold_italic(self):
@@ -478,14 +2159,31 @@ class EditorExtension(Extension):
         entries = "".join(entries)
         mw.app.clipboard().setText(entries)
 
+    MISC_UNFILL_REGEX = re.compile("\n *")
+    # Texts longer than this are inserted in chunks of this size, one per
+    # iteration of the webview's event loop, so that it stays responsive.
+    MISC_INSERT_CHUNK_SIZE = 64 * 1024
+
     @editor_command("Ctrl+Alt+Y")
     def misc_yank_unfilled(self):
+        """Inserts the text in the clipboard with its lines joined, which is
+        useful for text copied from PDFs. The clipboard is left unchanged."""
         text = mw.app.clipboard().text()
         text = unicodedata.normalize("NFC", text)
         text = text.strip()
-        text = re.sub("\n *", " ", text)
-        mw.app.clipboard().setText(text)
-        self.web.triggerPageAction(QWebEnginePage.Paste)
+        text = self.MISC_UNFILL_REGEX.sub(" ", text)
+        self.misc_insert_text(text)
+
+    def misc_insert_text(self, text):
+        size = self.MISC_INSERT_CHUNK_SIZE
+        # Split before escaping, so that no entity is split between chunks
+        chunks = [html.escape(text[start:start+size])
+                  for start in range(0, len(text), size)]
+        if len(chunks) == 1:
+            chunk = json.dumps(chunks[0])
+            self.eval_js(f'document.execCommand("insertHTML", false, {chunk});')
+        elif chunks:
+            self.eval_js(f"misc_insert_chunks({json.dumps(chunks)})")
 
     @editor_command("Ctrl+X, Y, O")
     def misc_yank_from_org(self):
@@ -504,18 +2202,27 @@ class EditorExtension(Extension):
         js = f"""document.execCommand("insertHTML", false, {text});"""
         self.eval_js(js)
 
+    @staticmethod
+    def misc_set_code_font(widget):
+        doc = widget.document()
+        font = doc.defaultFont()
+        font.setFamily("Ubuntu Mono")
+        font.setPointSize(15)
+        doc.setDefaultFont(font)
+
     class misc_CodeEdit(QTextEdit):
-        def __init__(self, ext, history, parent):
+        """The input of misc_RunCodeDialog. Ctrl+E evaluates the code and
+        Ctrl+Shift+E evaluates it in a background thread (when the language
+        supports it). Code starting with %timeit is timed instead, like in
+        IPython. The results are shown in the output of the dialog.
+        Subclasses define SELF.RUN(TEXT, TIMED, BACKGROUND)."""
+        def __init__(self, ext, lang, parent):
             super().__init__(parent)
             self.ext = ext
-            self.history = history
-            self.history_index = len(history) - 1
-            # setup the font
-            doc = self.document();
-            font = doc.defaultFont();
-            font.setFamily("Ubuntu Mono");
-            font.setPointSize(15)
-            doc.setDefaultFont(font);
+            self.lang = lang
+            self.history = code_history.get(lang)
+            self.history_index = len(self.history) - 1
+            ext.misc_set_code_font(self)
 
         def keyPressEvent(self, event):
             key, modifiers = event.key(), event.modifiers()
@@ -524,6 +2231,13 @@ class EditorExtension(Extension):
                     self.parent().accept()
                 elif key == Qt.Key_E:
                     self.eval(self.toPlainText())
+                elif key == Qt.Key_L:
+                    self.parent().output.clear()
+                else:
+                    super().keyPressEvent(event)
+            elif modifiers == Qt.ControlModifier | Qt.ShiftModifier:
+                if key == Qt.Key_E:
+                    self.eval(self.toPlainText(), background=True)
                 else:
                     super().keyPressEvent(event)
             elif modifiers == Qt.AltModifier:
@@ -553,9 +2267,16 @@ class EditorExtension(Extension):
             text = self.history[self.history_index]
             self.setText(text)
 
-        def eval(self, text):
-            self.history.append(text)
+        def eval(self, text, background=False):
+            code_history.append(self.lang, text)
             self.history_index = len(self.history)-1
+            timed = text.startswith("%timeit")
+            if timed:
+                text = text[len("%timeit"):].strip()
+            self.run(text, timed, background)
+
+        def show_result(self, result):
+            self.parent().output.appendPlainText(result)
 
     class misc_RunCodeDialog(QDialog):
         def __init__(self, ext, lang):
@@ -567,26 +2288,122 @@ class EditorExtension(Extension):
                 self.code_edit = ext.misc_PythonEdit(ext, self)
             else:
                 raise ValueError(f"Invalid language: \"{lang}\"")
+            self.output = QPlainTextEdit(self)
+            self.output.setReadOnly(True)
+            ext.misc_set_code_font(self.output)
             layout = QVBoxLayout()
-            layout.addWidget(self.code_edit)
+            layout.addWidget(self.code_edit, 2)
+            layout.addWidget(self.output, 1)
             self.setLayout(layout)
 
         def run(self):
             self.exec_()
-        
+
     class misc_JavaScriptEdit(misc_CodeEdit):
+        """The code is evaluated in the editor's webview. It always runs
+        asynchronously, so BACKGROUND makes no difference."""
         def __init__(self, ext, parent):
-            super().__init__(ext, ext.misc_js_history, parent)
-        def eval(self, text):
-            super().eval(text)
-            self.ext.eval_js(text)
+            super().__init__(ext, "javascript", parent)
+
+        def run(self, text, timed, background):
+            code = json.dumps(text)
+            if timed:
+                self.ext.eval_js_with_callback(f"misc_repl_timeit({code})",
+                                               self.show_timeit)
+            else:
+                self.ext.eval_js_with_callback(f"misc_repl_eval({code})",
+                                               self.show_eval)
+
+        def show_eval(self, result):
+            if result is None:
+                self.show_result("Error: the webview returned no result")
+            elif "error" in result:
+                self.show_result(result["error"])
+            else:
+                elapsed = format_duration(result["ms"] / 1000)
+                self.show_result(f"{result['repr']}\n[{elapsed}]")
+
+        def show_timeit(self, result):
+            if result is None:
+                self.show_result("Error: the webview returned no result")
+            elif "error" in result:
+                self.show_result(result["error"])
+            else:
+                loops = int(result["loops"])
+                best = format_duration(result["ms"] / 1000)
+                self.show_result(f"{loops} loops, best of 5: {best} per loop")
 
     class misc_PythonEdit(misc_CodeEdit):
+        # Compiled code objects, keyed by their source. Shared by all instances
+        # and bounded to the most recently used COMPILED_MAX entries.
+        COMPILED_MAX = 128
+        compiled = OrderedDict()
+        # The output of the run in each thread, so that runs in the background
+        # don't capture each other's output
+        outputs = threading.local()
+
+        @classmethod
+        def console_print(cls, *args, **kwargs):
+            """The print of the namespace, which writes to the output of the
+            run in the current thread, if any (and otherwise to stdout)"""
+            kwargs.setdefault("file", getattr(cls.outputs, "stream", None))
+            print(*args, **kwargs)
+
         def __init__(self, ext, parent):
-            super().__init__(ext, ext.misc_python_history, parent)
-        def eval(self, text):
-            super().eval(text)
-            exec(text, globals(), {"ext": self.ext})
+            super().__init__(ext, "python", parent)
+
+        @classmethod
+        def compile(cls, text):
+            """Returns a pair (CODE, IS_EXPRESSION)"""
+            try:
+                cls.compiled.move_to_end(text)
+                return cls.compiled[text]
+            except KeyError:
+                pass
+            try:
+                entry = (compile(text, "<repl>", "eval"), True)
+            except SyntaxError:
+                entry = (compile(text, "<repl>", "exec"), False)
+            cls.compiled[text] = entry
+            if len(cls.compiled) > cls.COMPILED_MAX:
+                cls.compiled.popitem(last=False)
+            return entry
+
+        def run(self, text, timed, background):
+            namespace = self.ext.misc_python_namespace
+            def task():
+                # Output of print is captured instead of going to stdout (see
+                # console_print). As print is looked up in the namespace, this
+                # includes calls from functions defined in the console.
+                output = self.outputs.stream = io.StringIO()
+                try:
+                    code, is_expression = self.compile(text)
+                    if timed:
+                        timer = timeit.Timer(
+                            lambda: eval(code, namespace))
+                        number, _ = timer.autorange()
+                        best = format_duration(min(timer.repeat(5, number)) / number)
+                        return f"{number} loops, best of 5: {best} per loop"
+                    start = time.perf_counter()
+                    value = eval(code, namespace)
+                    elapsed = format_duration(time.perf_counter() - start)
+                except Exception:
+                    return output.getvalue() + traceback.format_exc()
+                finally:
+                    self.outputs.stream = None
+                result = output.getvalue()
+                if is_expression and value is not None:
+                    result += repr(value) + "\n"
+                return f"{result}[{elapsed}]"
+            if background:
+                mw.taskman.run_in_background(task, self.show_background_result)
+            else:
+                self.show_result(task())
+
+        def show_background_result(self, future):
+            # The dialog may have been closed while the task ran
+            if not sip.isdeleted(self):
+                self.show_result(future.result())
 
     @editor_command("Ctrl+X, T, J")
     def misc_run_JS(self):
@@ -596,15 +2413,13 @@ class EditorExtension(Extension):
         dialog.setParent(None)
 
     @editor_command("Ctrl+X, T, F")
-    def misc_run_JS_from_file(self):
-        FILE = "/home/alex/scratch/scratch.js"
-        js = open(FILE).read()
-        self.eval_js(js)
-        print(f"### Executed \"{os.path.basename(FILE)}\"")
+    def misc_run_scratch_scripts(self):
+        """Runs the scratch scripts (see ScratchScripts) in this editor."""
+        scratch_scripts.run_all(self)
 
     @editor_command("Ctrl+X, T, P")
     def misc_run_Python(self):
-        """A rudimentary utility which enables one to run JS in the editor."""
+        """A rudimentary utility which enables one to run Python in the editor."""
         dialog = self.misc_RunCodeDialog(self, "python")
         dialog.run()
         dialog.setParent(None)
@@ -631,6 +2446,17 @@ class EditorExtension(Extension):
             note.fields[i] = pattern.sub("<br><hr><b>{UPDATE}</b>", field)
         self.editor.set_note(note)
 
+    @editor_command("Ctrl+X, T, E")
+    def misc_show_extension_counts(self):
+        """Shows how many extensions are alive, to check that closed windows
+        don't leave theirs behind."""
+        gc.collect()
+        handlers = gui_hooks.add_cards_did_add_note.count()
+        showInfo(f"Editor extensions: {len(editor_extensions)}\n"
+                 f"Add window extensions: {len(addcards_extensions)}\n"
+                 f"add_cards_did_add_note handlers: {handlers}",
+                 parent=self.editor.parentWindow)
+
     @editor_command("Ctrl+X, B")
     def misc_bold_to_code(self):
         self.eval_js("misc_bold_to_code()")
@@ -639,7 +2465,8 @@ class EditorExtension(Extension):
     def misc_insert_horizontal_ruler(self):
         self.eval_js('document.execCommand("insertHTML", false, "<hr>");')
 
-    @editor_command("Ctrl+Alt+R")
+    # Next to the formatting toggles. Ctrl+Alt+R is used by regexp isearch.
+    @editor_command("Ctrl+0")
     def misc_remove_formatting(self):
         self.editor.removeFormat()
 
@@ -753,8 +2580,13 @@ class EditorExtension(Extension):
             return
         identifier = self.identifiers_struct[choice]
         capitalize = self.identifiers_study_deck.filt[0].isupper()
-        if self.web.hasSelection():
-            stext = self.web.selectedText()
+        self.bridge_request("selection_text").add_done_callback(
+            lambda future: self.identifiers_insert_concept(
+                identifier, choice, capitalize,
+                future.result()["selection_text"]))
+
+    def identifiers_insert_concept(self, identifier, choice, capitalize, stext):
+        if stext:
             text = f'"<b><span concept={{{identifier}}}>#</span>{stext}</b>"'
         else:
             if capitalize and len(choice) > 0: choice = choice[0].upper() + choice[1:]
@@ -814,6 +2646,156 @@ class EditorExtension(Extension):
             self.identifiers_choice = self.identifiers_study_deck.name
         self.identifiers_rejected = False
 
+    # Automatic linking. Every occurrence (as a whole word, ignoring case) of
+    # an identifier or a synonym in the text of a note is wrapped in a concept
+    # span, like those inserted by identifiers_insert_direct. Text which is
+    # already linked or inside code is left alone.
+
+    # A triple (VERSION, AUTOMATON, IDENTIFIERS) shared by all editors, where
+    # VERSION identifies the contents of IDENTIFIERS_PATH and IDENTIFIERS maps
+    # each lowercased pattern to its identifier.
+    identifiers_automaton_cache = None
+    IDENTIFIERS_SKIPPED_TAGS = {"code", "pre", "a"}
+    IDENTIFIERS_VOID_TAGS = {"br", "hr", "img", "input", "meta", "wbr"}
+    IDENTIFIERS_TAG_REGEX = re.compile(r"<(/?)([a-zA-Z][a-zA-Z0-9]*)([^>]*)>")
+
+    def identifiers_automaton(self):
+        """Returns the pair (AUTOMATON, IDENTIFIERS), rebuilding it only when
+        the list of identifiers has changed."""
+        stat = os.stat(self.IDENTIFIERS_PATH)
+        version = (stat.st_mtime_ns, stat.st_size)
+        cache = EditorExtension.identifiers_automaton_cache
+        if cache is None or cache[0] != version:
+            self.identifiers_read()
+            identifiers = {}
+            for name, identifier in self.identifiers_struct.items():
+                identifiers.setdefault(name.lower(), identifier)
+            cache = (version, AhoCorasick(identifiers), identifiers)
+            EditorExtension.identifiers_automaton_cache = cache
+        return cache[1], cache[2]
+
+    def identifiers_link_html(self, field_html, automaton, identifiers):
+        """Returns a pair (NEW_HTML, LINKS), where LINKS is a list of pairs
+        (TEXT, IDENTIFIER) for the occurrences which were linked."""
+        links = []
+        result = []
+        # The open elements, as lists [TAG_NAME, SKIPPED]. The text inside an
+        # element with a true SKIPPED is not linked.
+        stack = []
+        for token in html_tokens(field_html):
+            match = self.IDENTIFIERS_TAG_REGEX.fullmatch(token)
+            if match:
+                closing, name, attributes = match.groups()
+                name = name.lower()
+                if closing:
+                    while stack:
+                        if stack.pop()[0] == name:
+                            break
+                elif name not in self.IDENTIFIERS_VOID_TAGS:
+                    if name == "span" and "concept" in attributes:
+                        # The text of a link is the rest of the enclosing <b>
+                        for element in reversed(stack):
+                            if element[0] == "b":
+                                element[1] = True
+                                break
+                    skipped = name in self.IDENTIFIERS_SKIPPED_TAGS
+                    stack.append([name, skipped])
+                result.append(token)
+            elif token and not any(skipped for _, skipped in stack):
+                result.append(self.identifiers_link_text(
+                    token, automaton, identifiers, links))
+            else:
+                result.append(token)
+        return "".join(result), links
+
+    def identifiers_link_text(self, raw, automaton, identifiers, links):
+        # Occurrences are found in the decoded text, so that entities (such as
+        # &lt;) are neither linked nor word boundaries.
+        html_text = HtmlText(raw)
+        text = html_text.text
+        lowered = text.lower()
+        if len(lowered) != len(text):
+            # Some characters change length when lowercased, so offsets in
+            # LOWERED would not be valid in TEXT.
+            lowered = text
+        is_word = lambda index: (0 <= index < len(text) and
+                                 (text[index].isalnum() or text[index] == "_"))
+        # Pick the leftmost-longest whole-word occurrences which don't overlap
+        occurrences = sorted(
+            (start, -end, pattern)
+            for start, end, pattern in automaton.find(lowered)
+            if not is_word(start - 1) and not is_word(end))
+        result = []
+        position = 0
+        for start, end, pattern in occurrences:
+            end = -end
+            if start < position:
+                continue
+            identifier = identifiers[pattern]
+            raw_start = html_text.raw_offset(start)
+            raw_end = html_text.raw_offset(end)
+            result.append(raw[html_text.raw_offset(position):raw_start])
+            result.append(f"<b><span concept={{{identifier}}}>#</span>"
+                          f"{raw[raw_start:raw_end]}</b>")
+            links.append((text[start:end], identifier))
+            position = end
+        result.append(raw[html_text.raw_offset(position):])
+        return "".join(result)
+
+    def identifiers_link_note(self, note):
+        """Links the fields of NOTE in place. Returns the list of links"""
+        automaton, identifiers = self.identifiers_automaton()
+        links = []
+        for index, field_html in enumerate(note.fields):
+            note.fields[index], field_links = self.identifiers_link_html(
+                field_html, automaton, identifiers)
+            links.extend(field_links)
+        return links
+
+    @staticmethod
+    def identifiers_confirm_links(links, parent):
+        shown = [f"{text} → {identifier}" for text, identifier in links[:30]]
+        if len(links) > 30:
+            shown.append("...")
+        text = f"Link {len(links)} occurrences?\n\n" + "\n".join(shown)
+        return askUser(text, parent=parent)
+
+    @editor_command("Ctrl+X, I, L")
+    def identifiers_autolink_note(self):
+        # Make sure that the note includes the latest edits first
+        self.editor.call_after_note_saved(self.identifiers_autolink_note_saved)
+
+    def identifiers_autolink_note_saved(self):
+        note = self.editor.note
+        original_fields = note.fields[:]
+        links = self.identifiers_link_note(note)
+        if not links:
+            tooltip("No identifiers found")
+        elif self.identifiers_confirm_links(links, self.editor.parentWindow):
+            self.editor.set_note(note)
+        else:
+            note.fields = original_fields
+
+    @editor_command("Ctrl+X, I, B")
+    def identifiers_autolink_selected_notes(self):
+        """Links the notes selected in the Browser which owns this editor"""
+        browser = self.editor.parentWindow
+        if not isinstance(browser, Browser):
+            tooltip("Not in the Browser")
+            return
+        notes = []
+        links = []
+        for note_id in browser.selected_notes():
+            note = mw.col.get_note(note_id)
+            note_links = self.identifiers_link_note(note)
+            if note_links:
+                notes.append(note)
+                links.extend(note_links)
+        if not links:
+            tooltip("No identifiers found")
+        elif self.identifiers_confirm_links(links, browser):
+            update_notes(parent=browser, notes=notes).run_in_background()
+
     # insert date
     # ════════════════════════════════════════
 
@@ -830,25 +2812,44 @@ class EditorExtension(Extension):
 # AddCards
 
 # addcards_commands is a dict which maps a method name to
-# a list pair [QKeySequence, QShortcut_or_None]
+# a list pair [QKeySequence, enabled]
 addcards_commands = {}
 def addcards_command(key_seq_str):
     def decorator(func):
-        addcards_commands[func.__name__] = [QKeySequence(key_seq_str), None]
+        addcards_commands[func.__name__] = [QKeySequence(key_seq_str), True]
         return func
     return decorator
 
+# The extensions of all open Add windows
+addcards_extensions = weakref.WeakSet()
+
+# Pairs (NOTE, DECK_ID) of the notes which failed to be rapidly added, to be
+# put back into an Add window (see AddCardsExtension.rapid_reset_editor).
+# Module-level, so that they outlive the window they were added from.
+rapid_failed_notes = []
+
 class AddCardsExtension(Extension):
     def __init__(self, addcards, bindings):
         self.addcards = self.widget = addcards
         self.editor = addcards.editor
         self.web = self.editor.web
         self.bindings = copy.deepcopy(bindings)
+        addcards_extensions.add(self)
+        self.setup_lifecycle()
+        qconnect(self.addcards.finished, self.teardown)
         self.setup_shortcuts()
         # extensions setup
         self.state_setup()
         self.typeauto_setup()
         self.prefix_setup()
+        self.rapid_setup()
+        self.dupes_setup()
+
+    def teardown(self, *args):
+        # Notes still waiting to be added must not be lost with the window
+        self.rapid_commit()
+        super().teardown()
+        addcards_extensions.discard(self)
 
     # ════════════════════════════════════════
     # prefix_first_field
@@ -857,8 +2858,8 @@ class AddCardsExtension(Extension):
         # attributes
         self.prefix = None
         # relevant hooks
-        gui_hooks.add_cards_did_add_note.append(
-            self.prefix_add_cards_did_add_note)
+        self.add_hook(gui_hooks.add_cards_did_add_note,
+                      self.prefix_add_cards_did_add_note)
 
     @addcards_command("Ctrl+X, P")
     def prefix_first_field(self):
@@ -912,8 +2913,8 @@ class AddCardsExtension(Extension):
     # invoking the clozing key.
 
     def typeauto_setup(self):
-        gui_hooks.add_cards_did_add_note.append(
-            self.typeauto_switch_to_basic)
+        self.add_hook(gui_hooks.add_cards_did_add_note,
+                      self.typeauto_switch_to_basic)
     
     @addcards_command("Ctrl+Shift+C")
     def typeauto_cloze(self):
@@ -932,7 +2933,7 @@ class AddCardsExtension(Extension):
         # must start at 1
         highest = max(1, highest)
         js = "wrap('{{c%d::', '}}');" % highest 
-        self.web.evalWithCallback(js, self.typeauto_onCloze_callback)
+        self.eval_js_with_callback(js, self.typeauto_onCloze_callback)
 
     @addcards_command("Ctrl+Shift+P")
     def typeauto_onCloze_optional(self):
@@ -948,11 +2949,14 @@ class AddCardsExtension(Extension):
         # must start at 1
         highest = max(1, highest)
         js = "wrap('{{c%d::', '::[optional]}}');" % highest 
-        self.web.evalWithCallback(js, self.typeauto_onCloze_callback)
+        self.eval_js_with_callback(js, self.typeauto_onCloze_callback)
 
     def typeauto_onCloze_callback(self, *args):
         # change the model
-        cloze_id = mw.col.models.id_for_name("Cloze")
+        cloze_id = collection_metadata.notetype_id("Cloze")
+        if cloze_id is None:
+            tooltip('There is no notetype named "Cloze"')
+            return
         self.addcards.notetype_chooser.selected_notetype_id = cloze_id
         # After changing the model, the point will be at the beginning, but I
         # want it after the closing bracket of the first cloze. This moves point
@@ -962,8 +2966,10 @@ class AddCardsExtension(Extension):
         self.eval_js("emacs_search('}}', 'forward')")
         
     def typeauto_switch_to_basic(self, *args):
-        basic_id = mw.col.models.id_for_name("Basic")
-        self.addcards.notetype_chooser.selected_notetype_id = basic_id
+        basic_id = collection_metadata.notetype_id("Basic")
+        chooser = self.addcards.notetype_chooser
+        if basic_id is not None and chooser.selected_notetype_id != basic_id:
+            chooser.selected_notetype_id = basic_id
 
     # ════════════════════════════════════════
     # state management
@@ -1002,11 +3008,20 @@ class AddCardsExtension(Extension):
         self.state_set(self.state_stored)
         
     def state_set(self, state):
-        self.addcards.notetype_chooser.selected_notetype_id = state["notetype_id"]
-        self.addcards.deck_chooser.selected_deck_id = state["deck_id"]
+        # The notetype or the deck may have been removed since the state was
+        # saved.
+        if collection_metadata.notetype_exists(state["notetype_id"]):
+            self.addcards.notetype_chooser.selected_notetype_id = state["notetype_id"]
+        else:
+            tooltip("The notetype of the state no longer exists")
+        if collection_metadata.deck_exists(state["deck_id"]):
+            self.addcards.deck_chooser.selected_deck_id = state["deck_id"]
+        else:
+            tooltip("The deck of the state no longer exists")
         note = self.editor.note
         for field_name, field_text in state["fields"].items():
-            note[field_name] = field_text
+            if field_name in note:
+                note[field_name] = field_text
         note.tags = state["tags"][:]
         self.editor.loadNote()
         self.state_update_tags_UI()
@@ -1097,6 +3112,157 @@ class AddCardsExtension(Extension):
         under the name "LAST"."""
         self.state_save_current("LAST")
         
+    # ════════════════════════════════════════
+    # Rapid adding. When enabled, Ctrl+Return queues the note and resets the
+    # editor right away (as if the note was added), and the queued notes are
+    # added to the collection in the background, in batches. A note which
+    # fails to be added is put back into the editor.
+
+    def rapid_setup(self):
+        self.rapid_enabled = False
+        # Pairs (NOTE, DECK_ID) waiting to be added
+        self.rapid_queue = []
+        # Not parented to the window, so that committing from teardown still
+        # works after the window is destroyed.
+        self.rapid_timer = QTimer()
+        self.rapid_timer.setSingleShot(True)
+        qconnect(self.rapid_timer.timeout, self.rapid_commit)
+        # Ctrl+Return is left to the Add button unless rapid adding is enabled
+        self.disable_command("rapid_add")
+        if rapid_failed_notes:
+            # Failed in a window which was closed since
+            self.rapid_reset_editor(None)
+
+    @addcards_command("Ctrl+X, R")
+    def rapid_toggle(self):
+        self.rapid_enabled = not self.rapid_enabled
+        if self.rapid_enabled:
+            self.enable_command("rapid_add")
+            tooltip("Rapid adding enabled")
+        else:
+            self.disable_command("rapid_add")
+            self.rapid_commit()
+            tooltip("Rapid adding disabled")
+
+    @addcards_command("Ctrl+Return")
+    def rapid_add(self):
+        self.editor.call_after_note_saved(self.rapid_add_saved)
+
+    def rapid_add_saved(self):
+        note = self.editor.note
+        if note.fields_check() == NoteFieldsCheckResult.EMPTY:
+            tooltip("The first field is empty")
+            return
+        deck_id = self.addcards.deck_chooser.selected_deck_id
+        self.rapid_queue.append((note, deck_id))
+        self.rapid_reset_editor(note)
+        if len(self.rapid_queue) >= config_get("rapid_add_batch_size"):
+            self.rapid_commit()
+        else:
+            self.rapid_timer.start(config_get("rapid_add_batch_delay_ms"))
+
+    def rapid_reset_editor(self, added_note):
+        """Loads the next note into the editor: a note which failed to be
+        added, if there is one, and otherwise a new note which keeps the sticky
+        fields of ADDED_NOTE."""
+        if rapid_failed_notes:
+            note, deck_id = rapid_failed_notes.pop(0)
+            self.addcards.notetype_chooser.selected_notetype_id = note.mid
+            self.addcards.deck_chooser.selected_deck_id = deck_id
+            self.editor.set_note(note, focusTo=0)
+            return
+        notetype = added_note.note_type()
+        note = mw.col.new_note(notetype)
+        for index, field in enumerate(notetype["flds"]):
+            if field["sticky"]:
+                note.fields[index] = added_note.fields[index]
+        note.tags = added_note.tags[:]
+        self.editor.set_note(note, focusTo=0)
+        # What the add_cards_did_add_note handlers do after a regular add
+        self.typeauto_switch_to_basic()
+        self.prefix_load()
+
+    def rapid_commit(self):
+        self.rapid_timer.stop()
+        if not self.rapid_queue:
+            return
+        batch, self.rapid_queue = self.rapid_queue, []
+        failed = []
+        def op(col):
+            undo_position = col.add_custom_undo_entry("Add Notes")
+            for note, deck_id in batch:
+                try:
+                    col.add_note(note, deck_id)
+                except Exception as error:
+                    failed.append((note, deck_id, error))
+            return col.merge_undo_entries(undo_position)
+        # The window may be closing, so the main window is the parent.
+        CollectionOp(parent=mw, op=op).success(
+            lambda changes: self.rapid_commit_done(batch, failed)
+        ).run_in_background(initiator=self)
+
+    def rapid_commit_done(self, batch, failed):
+        for note, deck_id in batch:
+            duplicate_index.update(note)
+        self.rapid_report_failures(failed)
+
+    def rapid_report_failures(self, failed):
+        if not failed:
+            return
+        lines = [f"{html_to_text_line(note.fields[0])[:50]}: {error}"
+                 for note, deck_id, error in failed]
+        rapid_failed_notes.extend(
+            (note, deck_id) for note, deck_id, _ in failed)
+        if sip.isdeleted(self.addcards):
+            where = ("They will be put back into the next Add window you "
+                     "open, one at a time.")
+        else:
+            where = ("They are put back into this Add window, one at a time, "
+                     "and what you were editing is stored (restore it with "
+                     "Ctrl+X, S, R).")
+        showWarning(f"{len(failed)} notes could not be added:\n\n" +
+                    "\n".join(lines) + "\n\n" + where)
+        if not sip.isdeleted(self.addcards):
+            # Keep what is being edited, so that it can be restored with
+            # state_restore.
+            self.state_store()
+            self.rapid_reset_editor(None)
+
+    # ════════════════════════════════════════
+    # Duplicate warnings based on duplicate_index (see DuplicateIndex), which
+    # unlike the check of Anki ignores the prefix of the first field.
+
+    def dupes_setup(self):
+        self.dupes_note_ids = set()
+        self.dupes_label = QLabel()
+        self.dupes_label.hide()
+        qconnect(self.dupes_label.linkActivated, self.dupes_show)
+        self.editor.outerLayout.insertWidget(0, self.dupes_label)
+        self.add_hook(gui_hooks.editor_did_fire_typing_timer, self.dupes_check)
+        self.add_hook(gui_hooks.editor_did_load_note, self.dupes_on_load_note)
+        duplicate_index.build()
+
+    def dupes_on_load_note(self, editor):
+        if editor is self.editor:
+            self.dupes_check(editor.note)
+
+    def dupes_check(self, note):
+        if note is not self.editor.note:
+            return
+        self.dupes_note_ids = duplicate_index.duplicates(note)
+        if self.dupes_note_ids:
+            count = len(self.dupes_note_ids)
+            self.dupes_label.setText(
+                f'Duplicate of {count} note{"s" if count > 1 else ""} '
+                f'(ignoring the prefix): <a href="#">show</a>')
+            self.dupes_label.show()
+        else:
+            self.dupes_label.hide()
+
+    def dupes_show(self, *args):
+        note_ids = ",".join(map(str, self.dupes_note_ids))
+        aqt.dialogs.open("Browser", mw, search=(f"nid:{note_ids}",))
+
     # ════════════════════════════════════════
     # misc
     @addcards_command("Ctrl+Alt+N")
@@ -1114,9 +3280,35 @@ def editor_did_init(editor):
     # attach as an attribute to prevent premature garbage collection
     editor._editor_extension = EditorExtension(editor, editor_commands)
 
+def webview_did_receive_js_message(handled, message, context):
+    if (isinstance(context, Editor) and
+        message.startswith(EditorExtension.BRIDGE_PREFIX)):
+        context._editor_extension.bridge_on_message(message)
+        return (True, None)
+    return handled
+
+def add_cards_did_add_note(note):
+    duplicate_index.update(note)
+
 def add_cards_did_init(addcards):
     # attach as an attribute to prevent premature garbage collection
     addcards._addcards_extension = AddCardsExtension(addcards, addcards_commands)
 
+command_index.build({"editor": (EditorExtension, editor_commands),
+                     "addcards": (AddCardsExtension, addcards_commands)})
+load_key_bindings(editor_commands)
+load_key_bindings(addcards_commands)
 gui_hooks.editor_did_init.append(editor_did_init)
 gui_hooks.add_cards_did_init.append(add_cards_did_init)
+gui_hooks.add_cards_did_add_note.append(add_cards_did_add_note)
+hooks.note_will_flush.append(duplicate_index.update)
+gui_hooks.operation_did_execute.append(
+    collection_metadata.on_operation_did_execute)
+gui_hooks.collection_did_load.append(collection_metadata.invalidate)
+gui_hooks.operation_did_execute.append(duplicate_index.on_operation_did_execute)
+gui_hooks.collection_did_load.append(duplicate_index.invalidate)
+hooks.notes_will_be_deleted.append(duplicate_index.on_notes_will_be_deleted)
+gui_hooks.webview_did_receive_js_message.append(webview_did_receive_js_message)
+qconnect(mw.app.applicationStateChanged, kill_ring.on_application_state_changed)
+scratch_scripts.setup()
+mw.addonManager.setConfigUpdatedAction(__name__, scratch_scripts.update_paths)
@@ -0,0 +1,181 @@
+// Microbenchmarks for the functions of editor_utils.js and
+// editor_extensions.js, run outside of Anki. The two files are loaded into a
+// jsdom window in which getCurrentField returns a synthetic field.
+//
+// Usage: node --expose-gc editor_bench.js [--size N] [--depth N] [--time MS]
+//                                         [--filter REGEX]
+//   --size    number of text nodes in the generated field (default 1000)
+//   --depth   nesting depth of the inline elements (default 4)
+//   --time    minimum measuring time per benchmark, in milliseconds (default 500)
+//   --filter  only run the benchmarks whose name matches REGEX
+// Without --expose-gc the allocation figures are left out.
+const fs = require("fs");
+const path = require("path");
+const {JSDOM} = require("jsdom");
+
+// options
+//════════════════════════════════════════
+function parse_options(argv){
+    const options = {size: 1000, depth: 4, time: 500, filter: null};
+    for (let i = 0; i < argv.length; i += 2){
+        const name = argv[i].replace(/^--/, ""), value = argv[i+1];
+        if (!(name in options) || value === undefined)
+            throw new Error("Invalid option: " + argv[i]);
+        options[name] = name === "filter" ? new RegExp(value) : Number(value);
+    }
+    return options;
+}
+// the editor
+//════════════════════════════════════════
+const SOURCES = ["editor_utils.js", "editor_extensions.js"];
+
+function create_editor(){
+    // Returns the jsdom window with the sources loaded and a field installed
+    const dom = new JSDOM("<!DOCTYPE html><body></body>",
+                          {runScripts: "outside-only"});
+    const window = dom.window;
+    // In Anki the field lives in a shadow root, whose getSelection is used by
+    // current_root(). The Selection of jsdom ignores nodes in shadow trees
+    // though, so here the document plays the role of the shadow root.
+    const input = window.document.createElement("div");
+    input.setAttribute("contenteditable", "true");
+    window.document.body.appendChild(input);
+    window.bench_field = {activeInput: input};
+    window.eval("function getCurrentField(){ return bench_field; }");
+    window.eval("function pycmd(message){}");
+    for (const source of SOURCES){
+        const text = fs.readFileSync(path.join(__dirname, "..", source), "utf8");
+        window.eval(text);
+    }
+    return {window, input};
+}
+// synthetic fields
+//════════════════════════════════════════
+const WORDS = ["lorem", "ipsum", "dolor", "sit", "amet", "consectetur",
+               "adipiscing", "elit", "sed", "do", "eiusmod", "tempor"];
+const TAGS = ["b", "i", "span", "u"];
+
+function generate_field(size, depth){
+    // Returns HTML with SIZE text nodes, wrapped in inline elements nested up
+    // to DEPTH levels, with some <code> and <b> elements for the functions
+    // which look for them. The output is deterministic.
+    let seed = 1;
+    const random = (n) => (seed = (seed * 16807) % 2147483647) % n;
+    const text = () => {
+        const words = [];
+        for (let i = random(8) + 1; i > 0; i--) words.push(WORDS[random(WORDS.length)]);
+        return words.join(" ") + " ";
+    };
+    const parts = [];
+    let remaining = size;
+    while (remaining > 0){
+        const levels = random(depth + 1);
+        const tags = [];
+        for (let i = 0; i < levels; i++) tags.push(TAGS[random(TAGS.length)]);
+        const leaf = random(10) === 0 ? "code" : "b";
+        parts.push(tags.map((tag) => `<${tag}>`).join(""));
+        parts.push(text(), `<${leaf}>${text()}</${leaf}>`);
+        parts.push(tags.reverse().map((tag) => `</${tag}>`).join(""));
+        parts.push(random(4) === 0 ? "<br>" : "");
+        remaining -= 2;
+    }
+    return parts.join("");
+}
+// benchmarks
+//════════════════════════════════════════
+// Each benchmark has a SETUP, which runs before every operation and is not
+// measured, and a RUN, which is the measured operation. Both receive the
+// window and the field's editable element.
+function place_point(window, input, fraction){
+    // Collapses the selection inside the text node at FRACTION of the field
+    const nodes = window.emacs_get_text_nodes(input);
+    const node = nodes[Math.floor((nodes.length - 1) * fraction)];
+    window.getSelection().collapse(node, 0);
+}
+function benchmarks(html){
+    const reset = ({input}) => { input.innerHTML = html; };
+    return {
+        emacs_get_text_nodes: {
+            setup: () => {},
+            run: ({window, input}) => window.emacs_get_text_nodes(input),
+        },
+        leaves: {
+            setup: () => {},
+            run: ({window, input}) => { for (const leaf of window.leaves(input)); },
+        },
+        emacs_search_forward_miss: {
+            setup: ({window, input}) => place_point(window, input, 0),
+            run: ({window}) => window.emacs_search("no such text", "forward"),
+        },
+        emacs_search_backward_hit: {
+            setup: ({window, input}) => place_point(window, input, 1),
+            run: ({window}) => window.emacs_search("lorem", "backward"),
+        },
+        split_code: {
+            setup: (editor) => reset(editor),
+            run: ({input, window}) => {
+                const code = input.querySelector("code");
+                if (code) window.split_code(code, 1);
+            },
+        },
+        misc_bold_to_code: {
+            setup: (editor) => reset(editor),
+            run: ({window}) => window.misc_bold_to_code(),
+        },
+        swap_preceding_type: {
+            setup: (editor) => {
+                reset(editor);
+                place_point(editor.window, editor.input, 1);
+            },
+            run: ({window}) => window.swap_preceding_type("B", "CODE"),
+        },
+    };
+}
+function measure_time(editor, benchmark, min_time){
+    // Returns the operations per second
+    let ops = 0, elapsed = 0n;
+    const limit = BigInt(min_time) * 1000000n;
+    while (elapsed < limit){
+        benchmark.setup(editor);
+        const start = process.hrtime.bigint();
+        benchmark.run(editor);
+        elapsed += process.hrtime.bigint() - start;
+        ops++;
+    }
+    return ops / (Number(elapsed) / 1e9);
+}
+const ALLOCATION_SAMPLES = 20;
+function measure_allocations(editor, benchmark){
+    // Returns the average heap growth per operation, or null when the garbage
+    // collector is not exposed. Collecting before each operation is too slow
+    // to be done while timing, so this is a separate pass.
+    if (!global.gc) return null;
+    let allocated = 0;
+    for (let i = 0; i < ALLOCATION_SAMPLES; i++){
+        benchmark.setup(editor);
+        global.gc();
+        const heap = process.memoryUsage().heapUsed;
+        benchmark.run(editor);
+        allocated += process.memoryUsage().heapUsed - heap;
+    }
+    return allocated / ALLOCATION_SAMPLES;
+}
+function main(){
+    const options = parse_options(process.argv.slice(2));
+    const editor = create_editor();
+    const html = generate_field(options.size, options.depth);
+    editor.input.innerHTML = html;
+    console.log(`field: ${options.size} text nodes, depth ${options.depth}, ` +
+                `${html.length} characters of HTML`);
+    for (const [name, benchmark] of Object.entries(benchmarks(html))){
+        if (options.filter && !options.filter.test(name)) continue;
+        editor.input.innerHTML = html;
+        const ops_per_sec = measure_time(editor, benchmark, options.time);
+        const bytes_per_op = measure_allocations(editor, benchmark);
+        const allocations = (bytes_per_op === null ? "" :
+                             `  ${(bytes_per_op / 1024).toFixed(1)} KiB/op`);
+        console.log(`${name.padEnd(28)} ${ops_per_sec.toFixed(1).padStart(12)} ops/sec` +
+                    allocations);
+    }
+}
+main();
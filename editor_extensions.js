@@ -99,7 +99,12 @@ function emacs_unset_extend_flag(){
     emacs_selection().collapse_to_focus()
     emacs_extend_flag = false;
 }
-function emacs_move(direction, unit){
+function emacs_move(direction, unit, count=1){
+    // Moves COUNT times, in the opposite DIRECTION if COUNT is negative
+    if (count < 0){
+        direction = direction == "forward" ? "backward" : "forward";
+        count = -count;
+    }
     let alter;
     let S = emacs_selection();
     if (!S.is_collapsed() || emacs_extend_flag){
@@ -107,7 +112,7 @@ function emacs_move(direction, unit){
     } else {
         alter = "move";
     }
-    S.modify(alter, direction, unit);
+    for (let i = 0; i < count; i++) S.modify(alter, direction, unit);
     if (alter === "extend" && S.is_collapsed()){
         // Sometimes a selection is active, which means that the movement
         // command should extend the selection, but then the movement results in
@@ -117,6 +122,9 @@ function emacs_move(direction, unit){
         emacs_extend_flag = true;
     }
 }
+function emacs_delete(count){
+    for (let i = 0; i < count; i++) document.execCommand("delete");
+}
 function emacs_goto(point){
     let S = emacs_selection();
     if (!S.is_collapsed()) {
@@ -177,6 +185,158 @@ function emacs_search(substr, direction){
     }
     return found;
 }
+// The field index and point where the isearch began
+let emacs_isearch_origin = null;
+
+function emacs_isearch_start(){
+    emacs_save_point();
+    emacs_isearch_origin = [bridge_getters.field_index(), emacs_saved_point];
+}
+function emacs_isearch_cancel(){
+    // Returns to where the isearch began, which may be in another field
+    const [field_index, point] = emacs_isearch_origin;
+    if (bridge_getters.field_index() !== field_index) focusField(field_index);
+    emacs_saved_point = point;
+    emacs_restore_point();
+}
+function emacs_isearch_result(found){
+    // The pair [FOUND, FIELD_INDEX] with which the search continues in the
+    // other fields
+    return [found !== false, bridge_getters.field_index()];
+}
+function emacs_isearch_update(substr, direction, regexp=false){
+    // Searches for SUBSTR from the point where the isearch began (or entered
+    // the current field). When REGEXP is true, SUBSTR is a regular expression,
+    // and while it is invalid (as it often is while being typed) the last
+    // match is kept.
+    if (!regexp) {
+        emacs_restore_point();
+        return emacs_isearch_result(substr ? emacs_search(substr, direction) : true);
+    }
+    if (substr && emacs_regexp(substr) === null) return emacs_isearch_result(null);
+    const S = emacs_selection();
+    const last_match = [S.anchorNode, S.anchorOffset, S.focusNode, S.focusOffset];
+    emacs_restore_point();
+    const found = substr ? emacs_search_regexp(substr, direction) : true;
+    if (found === null) S.setBaseAndExtent(...last_match);
+    return emacs_isearch_result(found);
+}
+function emacs_isearch_move(substr, direction, regexp=false){
+    return emacs_isearch_result(regexp ? emacs_search_regexp(substr, direction) :
+                                emacs_search(substr, direction));
+}
+function emacs_isearch_enter_field(index, substr, direction){
+    // Focuses the field INDEX, with point at its beginning (or end, when
+    // searching backward), and searches for SUBSTR from there.
+    focusField(index);
+    const input = getCurrentField().activeInput;
+    emacs_selection().collapse(
+        input, direction == "forward" ? 0 : input.childNodes.length);
+    emacs_save_point();
+    return emacs_isearch_result(emacs_search(substr, direction));
+}
+// regexp search
+//════════════════════════════════════════
+// Compiled regular expressions, by query. Invalid queries map to null.
+const emacs_regexp_cache = new Map();
+const EMACS_REGEXP_CACHE_MAX = 256;
+// A search gives up after this many matching steps or milliseconds. The
+// budget is only checked between matches, so it doesn't stop a single
+// catastrophic match.
+const EMACS_REGEXP_STEP_BUDGET = 100000;
+const EMACS_REGEXP_TIME_BUDGET = 50;
+// Quantified groups which contain a quantifier, as in (a+)+, or an
+// alternation, as in (a|aa)*, can make a single match backtrack
+// exponentially, so such patterns are refused. This is a heuristic: it only
+// looks at the innermost groups, and other catastrophic patterns can still
+// freeze the editor.
+const EMACS_REGEXP_NESTED_QUANTIFIER = /\([^()]*[+*}|][^()]*\)[+*{]/;
+
+function emacs_regexp(query){
+    // Returns QUERY compiled (case-insensitively), or null if it is invalid
+    let regexp = emacs_regexp_cache.get(query);
+    if (regexp !== undefined) return regexp;
+    regexp = null;
+    if (!EMACS_REGEXP_NESTED_QUANTIFIER.test(query)){
+        try {
+            regexp = new RegExp(query, "gi");
+        } catch (error) {}
+    }
+    if (emacs_regexp_cache.size >= EMACS_REGEXP_CACHE_MAX)
+        emacs_regexp_cache.clear();
+    emacs_regexp_cache.set(query, regexp);
+    return regexp;
+}
+function emacs_search_regexp(query, direction){
+    // Like emacs_search, but QUERY is a regular expression. Matches don't span
+    // text nodes. Returns whether a match was found, or null when the query is
+    // invalid or the search went over its budget.
+    const regexp = emacs_regexp(query);
+    if (regexp === null) return null;
+    const current = emacs_search_get_current(direction);
+    if (current === null) return false;
+    const [current_node, current_offset] = current;
+    const text_nodes = emacs_get_text_nodes();
+    const node_index = text_nodes.indexOf(current_node);
+    if (node_index === -1) return false;
+    const deadline = performance.now() + EMACS_REGEXP_TIME_BUDGET;
+    let steps = 0;
+    function* matches(text){
+        // Yields [START, END] for the non-empty matches in TEXT, at every
+        // starting position
+        regexp.lastIndex = 0;
+        let match;
+        while ((match = regexp.exec(text)) !== null) {
+            if (++steps > EMACS_REGEXP_STEP_BUDGET || performance.now() > deadline)
+                throw new RangeError("emacs_search_regexp: over budget");
+            if (match[0].length > 0)
+                yield [match.index, match.index + match[0].length];
+            regexp.lastIndex = match.index + 1;
+        }
+    }
+    function first_match(text, from){
+        for (const match of matches(text))
+            if (match[0] >= from) return match;
+        return null;
+    }
+    function last_match(text, before){
+        let found = null;
+        for (const match of matches(text)) {
+            if (match[0] >= before) break;
+            found = match;
+        }
+        return found;
+    }
+    let focusNode = null, focusOffset;
+    try {
+        if (direction == "forward"){
+            for (let i = node_index; i < text_nodes.length; i++){
+                const from = (i === node_index ? current_offset : 0);
+                const match = first_match(text_nodes[i].textContent, from);
+                if (match !== null){
+                    focusNode = text_nodes[i]; focusOffset = match[1];
+                    break;
+                }
+            }
+        } else {
+            for (let i = node_index; i >= 0; i--){
+                const text = text_nodes[i].textContent;
+                const before = (i === node_index ? current_offset : text.length + 1);
+                const match = last_match(text, before);
+                if (match !== null){
+                    focusNode = text_nodes[i]; focusOffset = match[0];
+                    break;
+                }
+            }
+        }
+    } catch (error) {
+        if (error instanceof RangeError) return null;
+        throw error;
+    }
+    if (focusNode === null) return false;
+    emacs_goto([focusNode, focusOffset]);
+    return true;
+}
 function emacs_search_get_current(direction){
     /* This function is necessary because the selection is not always on a Text node */
     let selection = emacs_selection();
@@ -295,3 +455,178 @@ function swap_preceding_type(from, to){
         emacs_goto([new_node.firstChild, offset]);
     current.remove();
 }
+// kill ring
+//════════════════════════════════════════
+// The text itself is kept on the Python side (see KillRing in __init__.py),
+// these functions only extract and insert it.
+let killring_yank_start = null, killring_yank_end = null;
+
+function killring_selection(remove){
+    // Returns the HTML and the text of the selection, or null when it is
+    // collapsed. When REMOVE is true, the selection is deleted.
+    const S = emacs_selection();
+    if (S.rangeCount === 0 || S.is_collapsed()) return null;
+    const container = document.createElement("div");
+    container.appendChild(S.getRangeAt(0).cloneContents());
+    const killed = {html: container.innerHTML, text: S.toString()};
+    if (remove) document.execCommand("delete");
+    return killed;
+}
+function killring_yank(html){
+    // Inserts HTML at point and remembers where it begins and ends, so that
+    // killring_yank_pop can replace it.
+    const S = emacs_selection();
+    if (S.rangeCount === 0) return;
+    // A live range, so that it follows the mutations of the insertion.
+    killring_yank_start = S.getRangeAt(0).cloneRange();
+    killring_yank_start.collapse(true);
+    document.execCommand("insertHTML", false, html);
+    killring_yank_end = S.get_focus();
+}
+function killring_yank_pop(html){
+    // Replaces the text inserted by the last yank with HTML. Returns false
+    // when point has moved since, i.e. the previous command was not a yank.
+    const S = emacs_selection();
+    if (killring_yank_start === null ||
+        !compare_arrays(S.get_focus(), killring_yank_end))
+        return false;
+    S.setBaseAndExtent(killring_yank_start.startContainer,
+                       killring_yank_start.startOffset,
+                       S.focusNode, S.focusOffset);
+    document.execCommand("insertHTML", false, html);
+    killring_yank_end = S.get_focus();
+    return true;
+}
+function misc_insert_chunks(chunks){
+    // Inserts the HTML strings in CHUNKS one at a time, each in its own task,
+    // so that the editor doesn't freeze while inserting very large texts.
+    // Every chunk goes where the previous one ended (POINT), even if the caret
+    // was moved, or text typed, in the meantime.
+    const input = getCurrentField().activeInput;
+    const root = current_root();
+    const S = emacs_selection();
+    if (S.rangeCount === 0) return;
+    let point = S.getRangeAt(0).cloneRange();
+    let index = 0;
+    (function insert_next(){
+        if (index >= chunks.length) return;
+        const html = chunks[index++];
+        if (current_root() !== root){
+            // The focus moved to another field, where execCommand would
+            // insert, so the chunk is inserted directly (and the field told).
+            const fragment = point.createContextualFragment(html);
+            const last = fragment.lastChild;
+            point.insertNode(fragment);
+            if (last) point.setStartAfter(last);
+            point.collapse(true);
+            input.dispatchEvent(new Event("input", {bubbles: true}));
+        } else {
+            const S = emacs_selection();
+            // A live range, which follows the mutations of the insertion
+            const user = S.rangeCount > 0 ? S.getRangeAt(0).cloneRange() : null;
+            const followed = user === null || (
+                user.collapsed &&
+                user.compareBoundaryPoints(Range.START_TO_START, point) === 0);
+            S.removeAllRanges();
+            S.addRange(point);
+            document.execCommand("insertHTML", false, html);
+            point = S.getRangeAt(0).cloneRange();
+            if (!followed){
+                S.removeAllRanges();
+                S.addRange(user);
+            }
+        }
+        setTimeout(insert_next, 0);
+    })();
+}
+// misc_repl
+//════════════════════════════════════════
+// Used by misc_JavaScriptEdit (the JavaScript console of the editor)
+function misc_repl_repr(value){
+    if (value instanceof Node)
+        return value.outerHTML ?? value.textContent;
+    if (typeof value === "function")
+        return value.toString();
+    try {
+        const json = JSON.stringify(value);
+        if (json !== undefined) return json;
+    } catch (error) {}
+    return String(value);
+}
+function misc_repl_eval(code){
+    // Evaluates CODE in the global scope. Returns the representation of its
+    // value along with the time the evaluation took.
+    try {
+        const start = performance.now();
+        const value = (0, eval)(code);
+        const ms = performance.now() - start;
+        return {repr: misc_repl_repr(value), ms: ms};
+    } catch (error) {
+        return {error: String(error)};
+    }
+}
+function misc_repl_timeit(code){
+    // Like %timeit in IPython: finds a number of loops which takes at least
+    // 0.2 seconds, and returns the best time per loop out of 5 repeats.
+    try {
+        const func = new Function(code);
+        const time = (loops) => {
+            const start = performance.now();
+            for (let i = 0; i < loops; i++) func();
+            return performance.now() - start;
+        };
+        let loops = 1;
+        while (time(loops) < 200) loops *= 10;
+        const times = [];
+        for (let i = 0; i < 5; i++) times.push(time(loops));
+        return {loops: loops, ms: Math.min(...times) / loops};
+    } catch (error) {
+        return {error: String(error)};
+    }
+}
+// bridge
+//════════════════════════════════════════
+// Answers the requests of the Python side (see bridge_request in
+// __init__.py). A request names the values it needs out of bridge_getters, and
+// all of them are sent back in a single message.
+const bridge_getters = {
+    selection_text() {
+        return emacs_selection().toString();
+    },
+    selection_html() {
+        const S = emacs_selection();
+        if (S.rangeCount === 0) return "";
+        const container = document.createElement("div");
+        container.appendChild(S.getRangeAt(0).cloneContents());
+        return container.innerHTML;
+    },
+    mark_active() {
+        return emacs_extend_flag || !emacs_selection().is_collapsed();
+    },
+    field_index() {
+        const field = getCurrentField();
+        return field ? Number(field.ord) : null;
+    },
+    field_html() {
+        return getCurrentField().activeInput.innerHTML;
+    },
+    caret_offset() {
+        // The number of characters between the beginning of the field and
+        // point
+        const S = emacs_selection();
+        const range = document.createRange();
+        range.setStart(getCurrentField().activeInput, 0);
+        range.setEnd(S.focusNode, S.focusOffset);
+        return range.toString().length;
+    },
+};
+function bridge_request(id, names){
+    const reply = {id: id, values: {}, error: null};
+    try {
+        for (const name of names)
+            reply.values[name] = bridge_getters[name]();
+    } catch (error) {
+        reply.error = String(error);
+    }
+    pycmd("editor_extensions_bridge:" + JSON.stringify(reply));
+}